@@ -0,0 +1,165 @@
+#!/bin/python
+"""
+Step response metrics of plant logfiles (data_log_*.csv, step_test.csv),
+computed with NumPy over any number of files in a process pool
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import re
+import os
+import sys
+import argparse as ap
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#settling band, relative to the step amplitude
+SETTLE_TOL = 0.02
+#rise time thresholds, relative to the step amplitude
+RISE_LOW = 0.1
+RISE_HIGH = 0.9
+#fraction of the samples at the end averaged as the final value
+FINAL_FRACTION = 0.05
+
+#summary table columns
+METRICS = ('rows', 't_step', 'y0', 'y_final', 'rise_t', 'settle_t',
+		   'overshoot', 'ss_error', 'iae', 'ise', 'itae')
+
+#-----------------------------------------------------------
+# Loading
+
+def load(path):
+	"""
+	Load a CSV logfile, either the plant data log (quoted upper case header,
+	tab separated) or a step test (comma separated)
+	:return dict of column name (lower case) -> array
+	"""
+	with open(path) as f:
+		header = f.readline()
+		rows = [l.replace(',', ' ') for l in f if l.strip()]
+	names = [n.strip().strip('"').lower()
+			 for n in re.split('[,\t]', header) if n.strip()]
+	data = np.loadtxt(rows, ndmin=2)
+	cols = dict(zip(names, data.T[:len(names)]))
+	if 't' in cols:
+		cols['time'] = cols.pop('t')
+	return cols
+
+#-----------------------------------------------------------
+# Metrics
+
+def integrate(f, t):
+	"""
+	Trapezoidal integral of f(t)
+	"""
+	return np.sum(0.5*(f[1:] + f[:-1])*np.diff(t))
+
+def first_time(mask, t):
+	"""
+	Time of the first True in mask, nan if none
+	"""
+	i = np.argmax(mask)
+	return t[i] if mask[i] else np.nan
+
+def step_metrics(cols):
+	"""
+	Step response metrics of a logfile
+	:param cols dict from load(), needs time and level, the step is taken
+	from setpoint (closed loop) or in_valve (open loop) when present
+	"""
+	t = cols['time']
+	y = cols['level']
+	ref = cols.get('setpoint')
+	u = ref if ref is not None else cols.get('in_valve')
+
+	#step at the first change of the reference or input
+	k = 0
+	if u is not None:
+		changed = np.flatnonzero(u != u[0])
+		k = changed[0] if changed.size else 0
+	t, y = t[k:] - t[k], y[k:]
+	y0 = y[0]
+	n_final = max(1, int(FINAL_FRACTION*y.size))
+	y_final = y[-n_final:].mean()
+	amp = y_final - y0
+
+	#response normalized to 0 at the step and 1 at the final value
+	yn = (y - y0)/amp if amp else np.zeros_like(y)
+	rise_t = first_time(yn >= RISE_HIGH, t) - first_time(yn >= RISE_LOW, t)
+	outside = np.flatnonzero(np.abs(yn - 1) > SETTLE_TOL)
+	settle_t = t[outside[-1]] if outside.size else 0.0
+	overshoot = max(0.0, yn.max() - 1)*100
+
+	#error against the reference, or the final value for open loop tests
+	r = ref[k:] if ref is not None else np.full_like(y, y_final)
+	e = r - y
+	return {
+		'rows': y.size + k,
+		't_step': cols['time'][k],
+		'y0': y0,
+		'y_final': y_final,
+		'rise_t': rise_t,
+		'settle_t': settle_t,
+		'overshoot': overshoot,
+		'ss_error': r[-n_final:].mean() - y_final,
+		'iae': integrate(np.abs(e), t),
+		'ise': integrate(e*e, t),
+		'itae': integrate(t*np.abs(e), t),
+	}
+
+def analyse(path):
+	"""
+	Metrics of one file, runs on a worker process
+	"""
+	try:
+		return path, step_metrics(load(path)), None
+	except Exception as e:
+		return path, None, str(e)
+
+#-----------------------------------------------------------
+# Output
+
+def print_table(results, out=sys.stdout, sep=None):
+	"""
+	Print the summary, one row per file
+	:param sep column separator, aligned columns if None
+	"""
+	header = ('file',) + METRICS
+	rows = [[os.path.basename(p)] + ['{:.4g}'.format(m[k]) for k in METRICS]
+			for p, m, _ in results if m is not None]
+	if sep is not None:
+		for r in [header] + rows:
+			out.write(sep.join(r) + '\n')
+		return
+	widths = [max(len(r[i]) for r in [header] + rows)
+			  for i in range(len(header))]
+	for r in [header] + rows:
+		out.write('  '.join(v.rjust(w) for v, w in zip(r, widths)) + '\n')
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	parser = ap.ArgumentParser(description='Step response metrics of plant '
+							   'logfiles')
+	parser.add_argument('files', nargs='+',
+						help='data_log_*.csv or step test files')
+	parser.add_argument('-j', '--jobs', type=int, default=None,
+						help='worker processes, defaults to the CPU count')
+	parser.add_argument('-o', '--out', help='write the summary as CSV')
+	args = parser.parse_args()
+
+	with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		results = list(pool.map(analyse, args.files, chunksize=8))
+
+	for path, _, err in results:
+		if err:
+			print('{}: {}'.format(path, err), file=sys.stderr)
+	print_table(results)
+	if args.out:
+		with open(args.out, 'w') as f:
+			print_table(results, f, sep=',')
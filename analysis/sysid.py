@@ -0,0 +1,249 @@
+#!/bin/python
+"""
+System identification from open loop step tests: fits first order plus dead
+time and second order plus dead time models with vectorized least squares and
+derives PI/PID tunings for the stepped valve, soft_plc.py --tunings needs an
+out valve step
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import sys
+import argparse as ap
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from step_analysis import load
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#raw register scale of the step test files (level 497 == 0.497)
+DEC_OFS = 1000
+#plant loop period [s], half of it is added to the dead time (sample and hold)
+T_STEP = 0.300
+
+#grid points per parameter of two parameter fits (about GRID_N**2 candidates
+#for any number of parameters), the best point is refined REFINE times
+GRID_N = 64
+REFINE = 6
+
+#-----------------------------------------------------------
+# Step data
+
+def step_data(cols, u0=None, input='in_valve'):
+	"""
+	Response from the input step on
+	:param u0 input before the step, only needed when the step happened
+		before the recording started
+	:param input column of the stepped input, in_valve or out_valve
+	:return t (from the step), y, du, y0
+	"""
+	t, y, u = cols['time'], cols['level'], cols[input]
+	changed = np.flatnonzero(u != u[0])
+	k = changed[0] if changed.size else 0
+	if changed.size:
+		du = u[k] - u[0]
+	elif u0 is not None:
+		du = u[0] - u0
+	else:
+		raise ValueError('no input step found, pass the input before the '
+						 'step with --u0')
+	return t[k:] - t[k], y[k:], du, y[0]
+
+#-----------------------------------------------------------
+# Least squares
+
+def fit_linear(phi, y):
+	"""
+	Least squares of y ~ a + b*phi for every row of phi at once
+	:param phi (G, T) candidate responses
+	:return a, b, sse, each (G,)
+	"""
+	n = y.size
+	s_p = phi.sum(-1)
+	s_pp = (phi*phi).sum(-1)
+	s_y = y.sum()
+	s_py = phi @ y
+	den = n*s_pp - s_p*s_p
+	den = np.where(den > 0, den, np.inf)
+	b = (n*s_py - s_p*s_y)/den
+	a = (s_y - b*s_p)/n
+	sse = (y*y).sum() - a*s_y - b*s_py
+	return a, b, sse
+
+def fopdt_response(t, tau, theta):
+	"""
+	Unit step response of 1/(tau*s + 1)*exp(-theta*s), broadcasts over the
+	parameters (trailing axis is time)
+	"""
+	ts = np.maximum(t - theta, 0)
+	return 1 - np.exp(-ts/tau)
+
+def sopdt_response(t, tau1, tau2, theta):
+	"""
+	Unit step response of 1/((tau1*s + 1)(tau2*s + 1))*exp(-theta*s),
+	tau1 > tau2, broadcasts over the parameters (trailing axis is time)
+	"""
+	ts = np.maximum(t - theta, 0)
+	return 1 - (tau1*np.exp(-ts/tau1) - tau2*np.exp(-ts/tau2))/(tau1 - tau2)
+
+def grid_search(response, t, y, bounds):
+	"""
+	Fit a + b*response(t, *params) over a grid of the nonlinear parameters,
+	the linear ones are solved in closed form for every grid point, then
+	zoom on the best point
+	:param bounds list of (lo, hi) of the nonlinear parameters
+	:return params, a, b, sse
+	"""
+	bounds = [list(b) for b in bounds]
+	n_grid = max(4, int(GRID_N**(2/len(bounds))))
+	for _ in range(REFINE + 1):
+		axes = [np.linspace(lo, hi, n_grid) for lo, hi in bounds]
+		mesh = [m.ravel()[:, None] for m in np.meshgrid(*axes, indexing='ij')]
+		with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+			phi = response(t[None, :], *mesh)
+			a, b, sse = fit_linear(np.nan_to_num(phi), y)
+		sse = np.where(np.isfinite(sse), sse, np.inf)
+		i = np.argmin(sse)
+		best = [m[i, 0] for m in mesh]
+		#zoom to the neighbouring grid points
+		for j, (lo, hi) in enumerate(bounds):
+			step = (hi - lo)/(n_grid - 1)
+			bounds[j] = [max(lo, best[j] - step), min(hi, best[j] + step)]
+	return best, a[i], b[i], sse[i]
+
+def fit_fopdt(t, y, du):
+	"""
+	:return dict with K, tau, theta, y0 and rmse
+	"""
+	span = t[-1]
+	(tau, theta), a, b, sse = grid_search(fopdt_response, t, y,
+										  [(span/1000, span), (0, span/4)])
+	return { 'K': b/du, 'tau': tau, 'theta': theta, 'y0': a,
+			 'rmse': np.sqrt(max(sse, 0)/y.size) }
+
+def fit_sopdt(t, y, du):
+	"""
+	:return dict with K, tau1, tau2, theta, y0 and rmse
+	"""
+	span = t[-1]
+	#tau2 as a fraction of tau1 keeps tau1 > tau2 on a rectangular grid
+	response = lambda t, tau1, r, theta: \
+		sopdt_response(t, tau1, r*tau1, theta)
+	(tau1, r, theta), a, b, sse = grid_search(
+		response, t, y, [(span/1000, span), (0.01, 0.99), (0, span/4)])
+	return { 'K': b/du, 'tau1': tau1, 'tau2': r*tau1, 'theta': theta, 'y0': a,
+			 'rmse': np.sqrt(max(sse, 0)/y.size) }
+
+#-----------------------------------------------------------
+# Tuning rules
+
+def parallel(kc, ti, td=0.0):
+	"""
+	Kc, Ti, Td to the (Kp, Ki, Kd) form used by simple_pid
+	"""
+	return (kc, kc/ti, kc*td)
+
+def tunings(fo, so, tau_c=None):
+	"""
+	PI/PID tunings of the fitted models for a controller driving the fitted
+	input, the gains take the sign of the model gain
+	:param fo fit_fopdt() result
+	:param so fit_sopdt() result
+	:param tau_c SIMC closed loop time constant, defaults to the dead time
+	but at least T_STEP (and tau2 for the PID), a near zero dead time would
+	give huge gains
+	:return dict of rule name -> (Kp, Ki, Kd)
+	"""
+	K, tau = fo['K'], fo['tau']
+	theta = fo['theta'] + T_STEP/2
+	r = theta/tau
+	tc = max(theta, T_STEP) if tau_c is None else tau_c
+	res = {
+		'zn_pi': parallel(0.9/(K*r), theta/0.3),
+		'zn_pid': parallel(1.2/(K*r), 2*theta, 0.5*theta),
+		'cc_pi': parallel((0.9 + r/12)/(K*r), theta*(30 + 3*r)/(9 + 20*r)),
+		'cc_pid': parallel((4/3 + r/4)/(K*r), theta*(32 + 6*r)/(13 + 8*r),
+						   4*theta/(11 + 2*r)),
+		'simc_pi': parallel(tau/(K*(tc + theta)), min(tau, 4*(tc + theta))),
+	}
+	#SIMC PID from the second order model, series form to parallel
+	theta2 = so['theta'] + T_STEP/2
+	tc2 = max(theta2, so['tau2'], T_STEP) if tau_c is None else tau_c
+	kc = so['tau1']/(so['K']*(tc2 + theta2))
+	ti = min(so['tau1'], 4*(tc2 + theta2))
+	td = so['tau2']
+	res['simc_pid'] = parallel(kc*(1 + td/ti), ti + td, ti*td/(ti + td))
+	return res
+
+#-----------------------------------------------------------
+# Files
+
+def identify(job):
+	"""
+	Fit one file, runs on a worker process
+	"""
+	path, u0, scale, tau_c, input = job
+	try:
+		cols = load(path)
+		if scale is None:
+			#step test files hold raw register values
+			scale = DEC_OFS if cols[input].max() > 1 else 1
+		cols = { k: v/scale if k != 'time' else v for k, v in cols.items() }
+		t, y, du, _ = step_data(cols, None if u0 is None else u0/scale,
+								input)
+		fo = fit_fopdt(t, y, du)
+		so = fit_sopdt(t, y, du)
+		return path, fo, so, tunings(fo, so, tau_c), None
+	except Exception as e:
+		return path, None, None, None, str(e)
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	parser = ap.ArgumentParser(description='Fit FOPDT and SOPDT models to open '
+							   'loop step tests and derive PI/PID tunings')
+	parser.add_argument('files', nargs='+',
+						help='step test files (t, level, outflow, in_valve)')
+	parser.add_argument('--u0', type=float,
+						help='input before the step, in file units, for files '
+						'recorded after the step')
+	parser.add_argument('--scale', type=float,
+						help='divide the level and input by this, defaults to '
+						'{} for raw register files'.format(DEC_OFS))
+	parser.add_argument('--tau_c', type=float,
+						help='SIMC closed loop time constant [s], defaults to '
+						'the dead time')
+	parser.add_argument('--input', choices=['in_valve', 'out_valve'],
+						default='in_valve',
+						help='stepped input column, defaults to in_valve. The '
+						'plant controller drives out_valve, its tunings need '
+						'an out_valve step (e.g. a data log in manual mode)')
+	parser.add_argument('-j', '--jobs', type=int, default=None,
+						help='worker processes, defaults to the CPU count')
+	args = parser.parse_args()
+
+	jobs = [(p, args.u0, args.scale, args.tau_c, args.input)
+			for p in args.files]
+	with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		results = list(pool.map(identify, jobs))
+
+	for path, fo, so, rules, err in results:
+		if err:
+			print('{}: {}'.format(path, err), file=sys.stderr)
+			continue
+		print(os.path.basename(path))
+		print('\tFOPDT K={K:.4g} tau={tau:.4g} theta={theta:.4g} '
+			  'rmse={rmse:.3g}'.format(**fo))
+		print('\tSOPDT K={K:.4g} tau1={tau1:.4g} tau2={tau2:.4g} '
+			  'theta={theta:.4g} rmse={rmse:.3g}'.format(**so))
+		if args.input != 'out_valve':
+			print('\t{} tunings, not for soft_plc.py which drives out_valve'
+				  .format(args.input))
+		for name, (kp, ki, kd) in rules.items():
+			print('\t{:9s}--tunings={:.4f},{:.4f},{:.4f}'.format(
+				name, kp, ki, kd))
@@ -0,0 +1,334 @@
+#!/bin/python
+"""
+Plant engine running on an asyncio event loop with a non-blocking modbus client
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import sys
+import time
+import signal
+import asyncio
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from pymodbus.factory import ClientDecoder
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+from pymodbus.exceptions import ConnectionException
+from pymodbus.bit_write_message import WriteSingleCoilRequest
+from pymodbus.register_read_message import ReadInputRegistersRequest, \
+	ReadWriteMultipleRegistersRequest
+from pymodbus.register_write_message import WriteSingleRegisterRequest, \
+	WriteMultipleRegistersRequest
+
+from plant import Plant, CLP_UNIT, V_OFS, REG_IN_VALVE, MBAP_HEADER, \
+	EX_ILLEGAL_FUNCTION
+from scheduler import FixedRateScheduler
+from sample import Sample
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#max wait for a response [s]
+TIMEOUT = 3.0
+
+#-------------------------------------------------------------------------------
+# Asyncio client
+
+class StreamModbusClient():
+	"""
+	Modbus TCP client on asyncio streams (the asyncio client of pymodbus 2.5
+	does not import on python 3.11). Requests are sent as soon as they are
+	made, several can be in flight on the connection, a reader task matches
+	the responses to them by transaction id.
+	"""
+	def __init__(self, host, port, timeout=TIMEOUT):
+		"""
+		:param timeout max wait for a response [s]
+		"""
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.framer = ModbusSocketFramer(ClientDecoder())
+		self.tids = count(1)
+		#transaction id -> future of the response
+		self.pending = {}
+		self.writer = None
+		self.receiver = None
+
+	async def connect(self):
+		reader, self.writer = await asyncio.open_connection(self.host,
+															self.port)
+		self.receiver = asyncio.ensure_future(self.receive(reader))
+
+	async def receive(self, reader):
+		"""
+		Read the responses until the connection closes, then fail the requests
+		still waiting for one
+		"""
+		try:
+			while True:
+				tid, _pid, length, _unit = MBAP_HEADER.unpack(
+					await reader.readexactly(MBAP_HEADER.size))
+				rs = self.framer.decoder.decode(
+					await reader.readexactly(length - 1))
+				f = self.pending.pop(tid, None)
+				if f is not None and not f.done():
+					f.set_result(rs)
+		except (asyncio.IncompleteReadError, OSError) as e:
+			error = e
+		for f in self.pending.values():
+			if not f.done():
+				f.set_exception(ConnectionException(
+					'{}:{}: {}'.format(self.host, self.port, error)))
+		self.pending.clear()
+
+	async def execute(self, request):
+		"""
+		Send a request and wait for its response
+		"""
+		if self.writer is None or self.receiver.done():
+			raise ConnectionException('{}:{} not connected'.format(
+				self.host, self.port))
+		#transaction ids are 16 bit
+		request.transaction_id = next(self.tids) & 0xffff
+		f = asyncio.get_event_loop().create_future()
+		self.pending[request.transaction_id] = f
+		self.writer.write(self.framer.buildPacket(request))
+		try:
+			return await asyncio.wait_for(f, self.timeout)
+		finally:
+			self.pending.pop(request.transaction_id, None)
+
+	def read_input_registers(self, address, count=1, unit=0):
+		return self.execute(ReadInputRegistersRequest(address, count,
+													  unit=unit))
+
+	def write_register(self, address, value, unit=0):
+		return self.execute(WriteSingleRegisterRequest(address, value,
+													   unit=unit))
+
+	def write_registers(self, address, values, unit=0):
+		return self.execute(WriteMultipleRegistersRequest(address, values,
+														  unit=unit))
+
+	def write_coil(self, address, value, unit=0):
+		return self.execute(WriteSingleCoilRequest(address, value, unit=unit))
+
+	def readwrite_registers(self, unit=0, **kwargs):
+		return self.execute(ReadWriteMultipleRegistersRequest(unit=unit,
+															  **kwargs))
+
+	def close(self):
+		if self.receiver is not None:
+			self.receiver.cancel()
+		if self.writer is not None:
+			self.writer.close()
+
+#-------------------------------------------------------------------------------
+# Non-blocking client
+
+class NoWaitClient():
+	"""
+	Wrap the asyncio modbus client so the Plant setters send their requests
+	without waiting for the response, errors are logged when it arrives
+	"""
+	def __init__(self, client, log):
+		self.client = client
+		self.log = log
+
+	def __getattr__(self, name):
+		request = getattr(self.client, name)
+		def send(*args, **kwargs):
+			f = asyncio.ensure_future(request(*args, **kwargs))
+			f.add_done_callback(self.check)
+		return send
+
+	def check(self, f):
+		"""
+		Log failed requests
+		"""
+		if f.cancelled():
+			return
+		if f.exception() is not None:
+			self.log.error('modbus request failed: %s', f.exception())
+		elif f.result().isError():
+			self.log.error('modbus error response: %s', f.result())
+
+#-------------------------------------------------------------------------------
+# Plant
+
+class AsyncPlant(Plant):
+	"""
+	Plant with the same Command/Output queue protocol, where valve writes,
+	commands and logging overlap the next sensor read instead of blocking it
+	"""
+	def make_client(self, dest_addr):
+		"""
+		The client is connected from inside the event loop in run()
+		"""
+		self.dest_addr = dest_addr
+		return None
+
+	async def connect(self):
+		"""
+		Connect to the plant modbus server
+		"""
+		self.async_client = StreamModbusClient(*self.dest_addr)
+		await self.async_client.connect()
+		self.client = NoWaitClient(self.async_client, self.log)
+		self.log.info('async client connected')
+
+	async def exchange_async(self):
+		"""
+		Write the pending valve registers and read all input registers
+		according to the I/O mode, as Plant.exchange(). The pipelined requests
+		are both in flight before waiting for either response.
+		"""
+		client = self.async_client
+		if self.io_mode == self.IOMode.SINGLE:
+			r = await client.read_input_registers(0, 4, unit=CLP_UNIT)
+			self.try_modbus_ex(r)
+			return r.registers
+
+		if self.io_mode == self.IOMode.FC23:
+			r = await client.readwrite_registers(
+				read_address=self.input_mirror, read_count=4,
+				write_address=REG_IN_VALVE, write_registers=self.out_regs,
+				unit=CLP_UNIT)
+			if r.isError() and \
+			   getattr(r, 'exception_code', None) == EX_ILLEGAL_FUNCTION:
+				self.round_trips += 1
+				self.log.warning('server lacks FC23, using pipelined requests')
+				self.io_mode = self.IOMode.PIPELINED
+			else:
+				self.try_modbus_ex(r)
+				return r.registers
+
+		wr, r = await asyncio.gather(
+			client.write_registers(REG_IN_VALVE, list(self.out_regs),
+								   unit=CLP_UNIT),
+			client.read_input_registers(0, 4, unit=CLP_UNIT))
+		self.try_modbus_ex(wr, rtt=0)
+		self.try_modbus_ex(r)
+		return r.registers
+
+	def log_sample(self, res):
+		"""
+		Write a sample to the logfile, runs on the logger thread
+		"""
+		self.sink.write(res)
+		self.log.debug('sample: %s', res)
+
+	def run(self, setpoint, out_valve, in_valve, \
+			_continue_sim=0, _end_sim=0, T_scale=1, _T_step=0.300,
+			_duration=0):
+		"""
+		Main function, runs run_async() on a new event loop
+		"""
+		asyncio.run(self.run_async(setpoint, out_valve, in_valve,
+								   _continue_sim, _end_sim, T_scale, _T_step,
+								   _duration))
+
+	async def run_async(self, setpoint, out_valve, in_valve, \
+						_continue_sim=0, _end_sim=0, T_scale=1, _T_step=0.300,
+						_duration=0):
+		"""
+		Run simulation loop with fixed time, outputting values to a queue and
+		processing commands from a queue
+		:param _duration stop after this time [s], 0 runs forever
+		"""
+		T_step = _T_step/T_scale #timestep adjusted for the timescale
+		pid = self.pid
+		loop = asyncio.get_event_loop()
+		#single thread keeps the log lines in order
+		logger = ThreadPoolExecutor(max_workers=1)
+		self.in_valve = in_valve
+		self.c = out_valve
+		pid.setpoint = setpoint
+
+		await self.connect()
+		self.log.info('async plant: T_step: %s T_scale: %s', T_step, T_scale)
+
+		self.pause()
+		self.sink.start(_continue_sim)
+
+		cmd_map = self.command_map()
+
+		#write initial values
+		self.write_in_valve(int(in_valve*V_OFS))
+		self.write_out_valve(int(out_valve*V_OFS))
+		if pid.auto_mode: pid.set_auto_mode(True, out_valve)
+
+		#start simulation and unpause
+		self.start(); self.unpause()
+		start_t = time.time()
+		self.started.value = start_t
+		sched = FixedRateScheduler(T_step, self.overrun, self.lateness,
+								   periods=self.periods)
+		last_c = None
+		timing = self.timing
+		overruns = sched.overruns
+
+		#flush the data log when the process is terminated
+		signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+		timing.start()
+		try:
+			while True:
+				self.round_trips = 0
+
+				level, outflow, setpoint, T_scale = await self.exchange_async()
+				level /= V_OFS #scale down values from 0-1000 -> 0.0-1.0
+				timing.mark('read')
+
+				#valve writes and commands are sent without waiting the response
+				if pid.auto_mode:
+					self.c = pid(level, dt=sched.last_period or T_step)
+					timing.mark('pid')
+					if self.c != last_c:
+						self.write_out_valve(int(self.c*V_OFS))
+						last_c = self.c
+						timing.mark('write')
+
+				self.process_command(cmd_map)
+				timing.mark('command')
+
+				res = Sample(time.time() - start_t, level, outflow/V_OFS, self.c,
+							 self.in_valve, pid.setpoint, sched.last_period,
+							 self.round_trips)
+				loop.run_in_executor(logger, self.log_sample, res)
+				timing.mark('log')
+				self.publish(res)
+				timing.mark('publish')
+
+				if _duration and res.time >= _duration:
+					break
+
+				await asyncio.sleep(sched.advance())
+				sched.tick()
+				timing.mark('sleep')
+				timing.end_cycle(sched.overruns != overruns)
+				overruns = sched.overruns
+
+			#used if the sym loop has a end condition
+			if _end_sim:
+				self.stop()
+			else:
+				self.pause()
+			#let the last requests go out before the loop closes
+			await asyncio.sleep(0)
+		finally:
+			logger.shutdown(wait=True)
+			self.sink.close()
+			self.async_client.close()
+			self.log.info('plant loop phases mean/max [ms]: %s',
+						  timing.summary())
+
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	print('This file should not be called directly, but included from '
+		  'soft_plc.py try running "python3 soft_plc.py -h" for more '
+		  'information')
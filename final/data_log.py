@@ -0,0 +1,462 @@
+#!/bin/python
+"""
+Plant data logfiles: CSV or binary columnar with a background writer,
+optionally rotated into compressed segments with a time index
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import io
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import struct
+import logging
+import threading
+import argparse as ap
+from array import array
+from queue import Queue
+
+from sample import FIELDS
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#binary logfile layout:
+# MAGIC, number of columns (u16), per column: name length (u8) + name
+# then blocks of: number of rows (u32) + each column as rows f64
+MAGIC = b'PSLOG001'
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+
+#rows per block and maximum time a row waits in memory [s]
+BLOCK_ROWS = 256
+FLUSH_INTERVAL = 10
+
+#CSV rows per compressed chunk of a closed segment
+CHUNK_ROWS = 256
+
+#------------------------------------------------------------------------------
+# CSV
+
+def csv_header():
+	return ''.join('"' + k.upper() + '",' for k in FIELDS)
+
+def csv_line(values):
+	return ''.join("{:0.4f}\t".format(v) for v in values)
+
+class CsvSink():
+	"""
+	Write each sample as a CSV line from the control loop
+	"""
+	ext = 'csv'
+
+	def __init__(self, path):
+		self.path = path
+		self.f = None
+
+	def start(self, _continue=0):
+		"""
+		Open the logfile, from the process that writes it
+		:param _continue append to the file without a new header
+		"""
+		self.f = open(self.path, 'ab' if _continue else 'wb')
+		if not _continue:
+			self.f.write((csv_header() + '\n').encode('utf-8'))
+
+	def write(self, sample):
+		self.f.write((csv_line(sample) + '\n').encode('utf-8'))
+
+	def size(self):
+		return self.f.tell()
+
+	def close(self):
+		self.f.close()
+
+#------------------------------------------------------------------------------
+# Binary
+
+def file_header():
+	h = MAGIC + U16.pack(len(FIELDS))
+	for k in FIELDS:
+		h += U8.pack(len(k)) + k.encode('ascii')
+	return h
+
+def little_endian(col):
+	"""
+	Column bytes in file byte order
+	"""
+	if sys.byteorder != 'little':
+		col = array('d', col)
+		col.byteswap()
+	return col.tobytes()
+
+class BinarySink():
+	"""
+	Append samples to in memory columns, a background thread writes them to
+	the logfile in blocks so the control loop does no formatting or file I/O
+	"""
+	ext = 'bin'
+
+	def __init__(self, path, block_rows=BLOCK_ROWS,
+				 flush_interval=FLUSH_INTERVAL):
+		self.path = path
+		self.block_rows = block_rows
+		self.flush_interval = flush_interval
+		self.thread = None
+
+	def new_columns(self):
+		return [array('d') for _ in FIELDS]
+
+	def start(self, _continue=0):
+		"""
+		Open the logfile and start the writer thread, from the process that
+		writes it
+		:param _continue append to an existing file
+		"""
+		self.f = open(self.path, 'ab' if _continue else 'wb')
+		if self.f.tell() == 0:
+			self.f.write(file_header())
+		self.written = self.f.tell()
+		self.cols = self.new_columns()
+		self.last_flush = time.monotonic()
+		self.blocks = Queue()
+		self.thread = threading.Thread(target=self.writer, name='data_log',
+									   daemon=True)
+		self.thread.start()
+
+	def write(self, sample):
+		for col, v in zip(self.cols, sample.fields()):
+			col.append(v)
+		if len(self.cols[0]) >= self.block_rows or \
+		   time.monotonic() - self.last_flush > self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		"""
+		Hand the buffered rows to the writer thread
+		"""
+		if len(self.cols[0]):
+			self.written += U32.size + 8*len(FIELDS)*len(self.cols[0])
+			self.blocks.put(self.cols)
+			self.cols = self.new_columns()
+		self.last_flush = time.monotonic()
+
+	def size(self):
+		"""
+		File size once the buffered rows are written
+		"""
+		return self.written + 8*len(FIELDS)*len(self.cols[0])
+
+	def writer(self):
+		while True:
+			cols = self.blocks.get()
+			if cols is None:
+				break
+			self.f.write(U32.pack(len(cols[0])) +
+						 b''.join(little_endian(c) for c in cols))
+			self.f.flush()
+
+	def close(self):
+		self.flush()
+		self.blocks.put(None)
+		self.thread.join()
+		self.f.close()
+
+def read_header(f):
+	"""
+	Read the header of a binary logfile
+	:return column names
+	"""
+	if f.read(len(MAGIC)) != MAGIC:
+		raise ValueError('not a data log file')
+	n, = U16.unpack(f.read(U16.size))
+	names = []
+	for _ in range(n):
+		l, = U8.unpack(f.read(U8.size))
+		names.append(f.read(l).decode('ascii'))
+	return names
+
+def read_blocks(f, ncols):
+	"""
+	Read the blocks of a binary logfile after its header
+	:return generator of blocks as lists of column arrays
+	"""
+	while True:
+		h = f.read(U32.size)
+		if len(h) < U32.size:
+			break
+		rows, = U32.unpack(h)
+		cols = []
+		for _ in range(ncols):
+			c = array('d')
+			c.frombytes(f.read(8*rows))
+			if sys.byteorder != 'little':
+				c.byteswap()
+			cols.append(c)
+		yield cols
+
+def read_binary(path):
+	"""
+	Read a binary logfile
+	:return column names, generator of blocks as lists of column arrays
+	"""
+	f = open(path, 'rb')
+	names = read_header(f)
+
+	def blocks():
+		with f:
+			yield from read_blocks(f, len(names))
+	return names, blocks()
+
+def to_csv(path, out):
+	"""
+	Convert a binary logfile to the CSV logfile format
+	:param out text file object
+	"""
+	names, blocks = read_binary(path)
+	out.write(''.join('"' + k.upper() + '",' for k in names) + '\n')
+	for cols in blocks:
+		for row in zip(*cols):
+			out.write(csv_line(row) + '\n')
+
+#------------------------------------------------------------------------------
+# Segments
+
+def segment_chunks(path):
+	"""
+	Split a closed logfile in chunks that can be decompressed on their own,
+	the file is read one chunk at a time
+	:return header bytes, generator of (first time, last time, rows, bytes)
+	"""
+	binary = path.endswith('.' + BinarySink.ext)
+	with open(path, 'rb') as f:
+		if binary:
+			names = read_header(f)
+			header_len = f.tell()
+			f.seek(0)
+			header = f.read(header_len)
+		else:
+			header = f.readline()
+
+	if binary:
+		ncols, t_col = len(names), names.index('time')
+		def chunks():
+			with open(path, 'rb') as f:
+				f.seek(len(header))
+				while True:
+					h = f.read(U32.size)
+					if len(h) < U32.size:
+						break
+					rows, = U32.unpack(h)
+					body = f.read(8*rows*ncols)
+					if len(body) < 8*rows*ncols:
+						break #block cut short by a killed plant
+					t = array('d')
+					t.frombytes(body[8*rows*t_col:8*rows*(t_col + 1)])
+					if sys.byteorder != 'little':
+						t.byteswap()
+					yield t[0], t[-1], rows, h + body
+		return header, chunks()
+
+	def chunk(rows):
+		return float(rows[0].split()[0]), float(rows[-1].split()[0]), \
+			len(rows), b''.join(rows)
+
+	def chunks():
+		with open(path, 'rb') as f:
+			f.seek(len(header))
+			rows = []
+			for l in f:
+				#a line cut short by a killed plant has no newline
+				if not l.strip() or not l.endswith(b'\n'):
+					continue
+				rows.append(l)
+				if len(rows) == CHUNK_ROWS:
+					yield chunk(rows)
+					rows = []
+			if rows:
+				yield chunk(rows)
+	return header, chunks()
+
+def compress_segment(path):
+	"""
+	Compress a closed logfile into path.gz, one gzip member per chunk, and
+	write the path.idx sidecar with the time range and compressed byte range
+	of each chunk, then remove the uncompressed file
+	"""
+	header, chunks = segment_chunks(path)
+	index = {'file': os.path.basename(path) + '.gz', 'rows': 0,
+			 'start': None, 'end': None, 'chunks': []}
+	with open(path + '.gz', 'wb') as out:
+		out.write(gzip.compress(header))
+		index['header'] = [0, out.tell()]
+		for t0, t1, rows, data in chunks:
+			offset = out.tell()
+			out.write(gzip.compress(data))
+			index['chunks'].append([t0, t1, offset, out.tell() - offset])
+			index['rows'] += rows
+			if index['start'] is None:
+				index['start'] = t0
+			index['end'] = t1
+	with open(path + '.idx', 'w') as f:
+		json.dump(index, f)
+	os.remove(path)
+
+def read_range(base, t0, t1):
+	"""
+	Rows with t0 <= time <= t1 from the compressed segments of a rotated
+	logfile, only the chunks that overlap the range are decompressed
+	:param base logfile path without segment number and extension
+	:return column names, generator of rows
+	"""
+	def member(f, offset, length):
+		f.seek(offset)
+		return gzip.decompress(f.read(length))
+
+	names = list(FIELDS)
+	def rows():
+		for idx_path in sorted(glob.glob(glob.escape(base) + '.*.idx')):
+			with open(idx_path) as f:
+				index = json.load(f)
+			if index['start'] is None or index['end'] < t0 or \
+			   index['start'] > t1:
+				continue
+			seg = os.path.join(os.path.dirname(idx_path), index['file'])
+			binary = index['file'].endswith(BinarySink.ext + '.gz')
+			with open(seg, 'rb') as f:
+				for c0, c1, offset, length in index['chunks']:
+					if c1 < t0 or c0 > t1:
+						continue
+					data = member(f, offset, length)
+					if binary:
+						block = [zip(*cols) for cols in
+								 read_blocks(io.BytesIO(data), len(names))]
+						chunk = (r for b in block for r in b)
+					else:
+						chunk = (tuple(float(v) for v in l.split())
+								 for l in data.splitlines() if l.strip())
+					for r in chunk:
+						if t0 <= r[0] <= t1:
+							yield r
+	return names, rows()
+
+class RotatingSink():
+	"""
+	Write the log in numbered segments, starting a new one when the current
+	reaches a size or an age. Closed segments are compressed with a time
+	index by a background thread.
+	"""
+	def __init__(self, sink_type, base, max_bytes=None, max_age=None):
+		"""
+		:param sink_type CsvSink or BinarySink
+		:param base logfile path without extension
+		:param max_bytes, max_age segment size [bytes] and age [s] limits
+		"""
+		self.sink_type = sink_type
+		self.base = base
+		self.path = '{}.*.{}'.format(base, sink_type.ext)
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.segment = None
+
+	def next_segment(self):
+		"""
+		Open the next free segment number
+		"""
+		n = 0
+		for p in glob.glob(glob.escape(self.base) + '.*'):
+			m = re.match(r'\.(\d+)\.', p[len(self.base):])
+			if m:
+				n = max(n, int(m.group(1)) + 1)
+		self.segment = self.sink_type('{}.{:04d}.{}'.format(
+			self.base, n, self.sink_type.ext))
+		self.segment.start()
+		self.opened = time.monotonic()
+
+	def start(self, _continue=0):
+		"""
+		Start the compressor thread and the first segment, a continued log
+		simply gets a new segment
+		"""
+		self.closed = Queue()
+		self.thread = threading.Thread(target=self.compressor,
+									   name='data_log_compress', daemon=True)
+		self.thread.start()
+		self.next_segment()
+
+	def write(self, sample):
+		self.segment.write(sample)
+		if (self.max_bytes and self.segment.size() >= self.max_bytes) or \
+		   (self.max_age and time.monotonic() - self.opened >= self.max_age):
+			self.closed.put(self.segment)
+			self.next_segment()
+
+	def compressor(self):
+		while True:
+			segment = self.closed.get()
+			if segment is None:
+				break
+			segment.close()
+			#a bad segment must not stop the compression of the next ones
+			try:
+				compress_segment(segment.path)
+			except Exception:
+				logging.getLogger(__name__).exception(
+					'compressing %s failed', segment.path)
+
+	def close(self):
+		self.closed.put(self.segment)
+		self.closed.put(None)
+		self.thread.join()
+
+#------------------------------------------------------------------------------
+# Sinks
+
+SINKS = {s.ext: s for s in (CsvSink, BinarySink)}
+
+def make_sink(fmt, path, max_bytes=None, max_age=None):
+	"""
+	:param fmt 'csv' or 'bin'
+	:param path logfile path without extension
+	:param max_bytes, max_age rotate the log in compressed segments when
+	one of them is given
+	"""
+	if max_bytes or max_age:
+		return RotatingSink(SINKS[fmt], path, max_bytes, max_age)
+	return SINKS[fmt](path + '.' + fmt)
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	parser = ap.ArgumentParser(description='Data log tools')
+	sub = parser.add_subparsers(dest='cmd', required=True)
+	conv = sub.add_parser('convert', help='convert a binary data log to CSV')
+	conv.add_argument('logfile', help='binary data log (.bin)')
+	conv.add_argument('out', nargs='?',
+					  help='CSV output, defaults to the logfile with .csv')
+	query = sub.add_parser('query', help='print the rows of a rotated data '
+						   'log within a time range as CSV')
+	query.add_argument('base', help='logfile path without segment number '
+					   'and extension')
+	query.add_argument('t0', type=float, help='range start [s]')
+	query.add_argument('t1', type=float, help='range end [s]')
+	args = parser.parse_args()
+
+	if args.cmd == 'convert':
+		out = args.out or os.path.splitext(args.logfile)[0] + '.csv'
+		with open(out, 'w') as f:
+			to_csv(args.logfile, f)
+		print('wrote', out)
+	else:
+		names, rows = read_range(args.base, args.t0, args.t1)
+		print(''.join('"' + k.upper() + '",' for k in names))
+		for r in rows:
+			print(csv_line(r))
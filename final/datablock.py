@@ -0,0 +1,97 @@
+#!/bin/python
+"""
+Compact modbus data blocks: registers in an array of 16 bit integers and
+coils/discrete inputs packed 8 per byte
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+from array import array
+from pymodbus.datastore.store import BaseModbusDataBlock
+
+#------------------------------------------------------------------------------
+# Registers
+
+class RegisterBlock(BaseModbusDataBlock):
+	"""
+	Sequential registers stored in an array('H'), reads return memoryview
+	slices of it (valid until the registers are written again)
+	"""
+	def __init__(self, address, count, value=0):
+		"""
+		:param address first address
+		:param count number of registers
+		:param value initial value of every register
+		"""
+		self.address = address
+		self.default_value = value
+		self.values = array('H', [value])*count
+		self.view = memoryview(self.values)
+
+	def reset(self):
+		self.view[:] = array('H', [self.default_value])*len(self.values)
+
+	def validate(self, address, count=1):
+		start = address - self.address
+		return start >= 0 and start + count <= len(self.values)
+
+	def getValues(self, address, count=1):
+		start = address - self.address
+		return self.view[start:start+count]
+
+	def setValues(self, address, values):
+		if not isinstance(values, (list, tuple, array, memoryview)):
+			values = [values]
+		start = address - self.address
+		#16 bit registers, negative values in two's complement
+		self.view[start:start+len(values)] = array('H',
+			[v & 0xffff for v in values])
+
+#------------------------------------------------------------------------------
+# Bits
+
+class BitBlock(BaseModbusDataBlock):
+	"""
+	Sequential coils or discrete inputs packed 8 per byte, least significant
+	bit first (the modbus wire order)
+	"""
+	def __init__(self, address, count, value=False):
+		"""
+		:param address first address
+		:param count number of bits
+		:param value initial value of every bit
+		"""
+		self.address = address
+		self.count = count
+		self.default_value = bool(value)
+		self.bits = bytearray(b'\xff' if value else b'\x00')*((count + 7)//8)
+
+	@property
+	def values(self):
+		return self.getValues(self.address, self.count)
+
+	def reset(self):
+		self.bits[:] = (b'\xff' if self.default_value else b'\x00') * \
+			len(self.bits)
+
+	def validate(self, address, count=1):
+		start = address - self.address
+		return start >= 0 and start + count <= self.count
+
+	def getValues(self, address, count=1):
+		start = address - self.address
+		bits = self.bits
+		return [bool(bits[i >> 3] >> (i & 7) & 1)
+				for i in range(start, start + count)]
+
+	def setValues(self, address, values):
+		if not isinstance(values, (list, tuple)):
+			values = [values]
+		start = address - self.address
+		bits = self.bits
+		for i, v in enumerate(values, start):
+			if v:
+				bits[i >> 3] |= 1 << (i & 7)
+			else:
+				bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
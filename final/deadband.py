@@ -0,0 +1,113 @@
+#!/bin/python
+"""
+Report by exception: only publish plant samples whose signals moved past a
+deadband, or after a maximum silence (heartbeat)
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import time
+import argparse as ap
+from multiprocessing import Array
+
+from sample import FIELDS
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#signals compared by default, any change is reported
+SIGNALS = ('level', 'outflow', 'out_valve', 'in_valve', 'setpoint')
+#max time without a report [s]
+HEARTBEAT = 10.0
+
+#-----------------------------------------------------------
+# Utilities
+
+def parse_deadband(arg):
+	"""
+	Parse signal=abs, signal=pct% or signal=abs,pct%, signal is a Sample
+	field
+	:return (signal, (abs, pct))
+	"""
+	signal, _, value = arg.partition('=')
+	signal = signal.strip()
+	if signal not in FIELDS:
+		raise ap.ArgumentTypeError('unknown signal {}, one of {}'.format(
+			signal, ', '.join(FIELDS)))
+	abs_db = pct_db = 0.0
+	for v in value.split(','):
+		v = v.strip()
+		if v.endswith('%'):
+			pct_db = float(v[:-1])
+		elif v:
+			abs_db = float(v)
+	return signal, (abs_db, pct_db)
+
+#------------------------------------------------------------------------------
+# Filter
+
+class ExceptionReport():
+	"""
+	Decides which samples are published: a signal changed by more than
+	max(abs, pct% of its last reported value) or the last report is older
+	than the heartbeat. The reported/suppressed counters can be shared with
+	other processes.
+	"""
+	def __init__(self, deadbands=None, heartbeat=HEARTBEAT, shared=False,
+				 clock=time.monotonic):
+		"""
+		:param deadbands dict of Sample field -> (abs, pct), the SIGNALS not
+		in it report any change
+		:param heartbeat max time without a report [s], 0 disables it
+		:param shared keep the counters in shared memory
+		:param clock time source [s]
+		"""
+		self.deadbands = dict.fromkeys(SIGNALS, (0.0, 0.0))
+		self.deadbands.update(deadbands or {})
+		self.heartbeat = heartbeat
+		self.clock = clock
+		self.last = None
+		self.last_t = 0
+		#reported, suppressed
+		self.counts = Array('Q', 2) if shared else [0, 0]
+
+	def changed(self, sample):
+		"""
+		Check a sample and count it
+		:return True if it should be published
+		"""
+		now = self.clock()
+		report = self.last is None or \
+			(self.heartbeat and now - self.last_t >= self.heartbeat)
+		if not report:
+			for field, (abs_db, pct_db) in self.deadbands.items():
+				last = getattr(self.last, field)
+				delta = abs(getattr(sample, field) - last)
+				if delta > max(abs_db, pct_db*abs(last)/100):
+					report = True
+					break
+		if report:
+			self.last = sample
+			self.last_t = now
+			self.counts[0] += 1
+		else:
+			self.counts[1] += 1
+		return report
+
+	@property
+	def reported(self):
+		return self.counts[0]
+
+	@property
+	def suppressed(self):
+		return self.counts[1]
+
+	def summary(self):
+		"""
+		Counters as text
+		"""
+		total = self.counts[0] + self.counts[1]
+		return 'reported {} suppressed {} ({:.1f}%)'.format(
+			self.counts[0], self.counts[1],
+			100*self.counts[1]/total if total else 0)
@@ -0,0 +1,64 @@
+#!/bin/python
+"""
+Readiness signal between processes, lets the SoftPLC reactor sleep until a
+plant publishes a sample instead of polling its queue
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#max bytes read from the pipe at once
+DRAIN_SIZE = 4096
+
+#------------------------------------------------------------------------------
+# Doorbell
+
+class Doorbell():
+	"""
+	Non blocking pipe, the producer writes one byte per ring and the consumer
+	polls the read end (select/epoll) and drains it. Must be created before
+	the processes are started (the file descriptors are inherited).
+	"""
+	def __init__(self):
+		self.r, self.w = os.pipe()
+		os.set_blocking(self.r, False)
+		os.set_blocking(self.w, False)
+
+	def fileno(self):
+		"""
+		Read end, ready when the bell was rung
+		"""
+		return self.r
+
+	def ring(self):
+		"""
+		Signal the consumer, producer side
+		"""
+		try:
+			os.write(self.w, b'\x01')
+		except BlockingIOError:
+			pass #pipe full, the consumer already has pending rings
+
+	def drain(self):
+		"""
+		Clear the pending rings, consumer side
+		:return number of rings since the last drain
+		"""
+		n = 0
+		while True:
+			try:
+				data = os.read(self.r, DRAIN_SIZE)
+			except BlockingIOError:
+				return n
+			if not data:
+				return n
+			n += len(data)
+
+	def close(self):
+		os.close(self.r)
+		os.close(self.w)
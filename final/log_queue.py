@@ -0,0 +1,176 @@
+#!/bin/python
+"""
+Logging off the control loop: records go through a bounded queue to a
+listener thread that does the formatting and the writes, after a per message
+type sampling and rate limiting filter
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import time
+import logging
+from queue import Full
+from multiprocessing import Queue, Value
+from logging.handlers import QueueHandler, QueueListener
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#records waiting for the listener, more are dropped
+QUEUE_LEN = 10000
+#messages per second of each message type, 0 disables the limit
+RATE = 5.0
+#messages of a type logged at once before the rate limit applies
+BURST = 20
+#message types tracked, the filter forgets them all when there are more
+#(an eagerly formatted message is a new type on every call)
+MAX_TYPES = 1000
+#argument types sent unformatted through the queue, others may not pickle
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+#-----------------------------------------------------------
+# Utilities
+
+def parse_sampling(arg):
+	"""
+	Parse LEVEL=N, keep one of every N records of each message type of that
+	level
+	:return (level number, N)
+	"""
+	level, _, n = arg.partition('=')
+	levelno = logging.getLevelName(level.strip().upper())
+	if not isinstance(levelno, int):
+		raise ValueError('unknown log level {}'.format(level))
+	return levelno, max(1, int(n))
+
+#------------------------------------------------------------------------------
+# Filter
+
+class RateLimitFilter(logging.Filter):
+	"""
+	Sampling and token bucket rate limit of each message type (logger, level
+	and the unformatted message, so the calls must use lazy % arguments).
+	The first record let through after suppressed ones says how many were.
+	Runs before the record is formatted, a dropped record costs a dict
+	lookup.
+	"""
+	def __init__(self, rate=RATE, burst=BURST, sampling=None,
+				 clock=time.monotonic):
+		"""
+		:param rate messages per second of each type, 0 disables the limit
+		:param burst messages of a type let through at once
+		:param sampling dict of level number -> N, keep one of every N
+		records of each type of that level
+		:param clock time source [s]
+		"""
+		super().__init__()
+		self.rate = rate
+		self.burst = burst
+		self.sampling = dict(sampling or {})
+		self.clock = clock
+		#type -> [tokens, last refill time, records seen, suppressed]
+		self.types = {}
+		self.sampled = 0
+		self.suppressed = 0
+
+	def filter(self, record):
+		key = (record.name, record.levelno, record.msg)
+		state = self.types.get(key)
+		now = self.clock()
+		if state is None:
+			if len(self.types) >= MAX_TYPES:
+				self.types.clear()
+			state = self.types[key] = [self.burst, now, 0, 0]
+		state[2] += 1
+		if (state[2] - 1) % self.sampling.get(record.levelno, 1):
+			self.sampled += 1
+			return False
+		if self.rate:
+			state[0] = min(self.burst, state[0] + (now - state[1])*self.rate)
+			state[1] = now
+			if state[0] < 1:
+				state[3] += 1
+				self.suppressed += 1
+				return False
+			state[0] -= 1
+		if state[3]:
+			#no % in the suffix, the message is still formatted with its args
+			record.msg = '{} ({} similar suppressed)'.format(record.msg,
+															 state[3])
+			state[3] = 0
+		return True
+
+	def summary(self):
+		"""
+		Counters as text
+		"""
+		return 'types {} sampled out {} rate limited {}'.format(
+			len(self.types), self.sampled, self.suppressed)
+
+#------------------------------------------------------------------------------
+# Queue
+
+class DroppingQueueHandler(QueueHandler):
+	"""
+	QueueHandler that never waits and leaves the formatting to the listener:
+	records that don't fit in the queue are counted in dropped (shared by
+	the processes using the handler)
+	"""
+	def __init__(self, queue):
+		super().__init__(queue)
+		self.dropped = Value('Q', 0)
+		self.exc_formatter = logging.Formatter()
+
+	def prepare(self, record):
+		"""
+		Keep msg and args as they are (the queue pickles them on its feeder
+		thread) when the args are plain values, otherwise format the message
+		here since they may not pickle. Tracebacks are always rendered.
+		"""
+		args = record.args or ()
+		values = args.values() if isinstance(args, dict) else args
+		if not isinstance(record.msg, str) or \
+		   not all(isinstance(v, PLAIN_TYPES) for v in values):
+			record.msg = record.getMessage()
+			record.args = None
+		if record.exc_info:
+			record.exc_text = self.exc_formatter.formatException(
+				record.exc_info)
+			record.exc_info = None
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			with self.dropped.get_lock():
+				self.dropped.value += 1
+
+def start_logging(level, rate=RATE, burst=BURST, sampling=None,
+				  q_len=QUEUE_LEN, handler=None):
+	"""
+	Route the root logger through a queue to a listener thread, call before
+	starting processes: they inherit the handler and their records go to the
+	same listener. Each process rate limits its own records.
+	:param level root logger level
+	:param rate, burst, sampling see RateLimitFilter
+	:param handler handler the listener writes to, stderr by default
+	:return QueueListener (stop() it on exit to flush), DroppingQueueHandler,
+	RateLimitFilter
+	"""
+	queue = Queue(q_len)
+	queue_handler = DroppingQueueHandler(queue)
+	limit = RateLimitFilter(rate, burst, sampling)
+	queue_handler.addFilter(limit)
+	if handler is None:
+		handler = logging.StreamHandler()
+		handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+	root = logging.getLogger()
+	for h in root.handlers[:]:
+		root.removeHandler(h)
+	root.addHandler(queue_handler)
+	root.setLevel(level)
+	listener = QueueListener(queue, handler)
+	listener.start()
+	return listener, queue_handler, limit
@@ -0,0 +1,138 @@
+#!/bin/python
+"""
+Metrics in the Prometheus text format served over HTTP by the SoftPLC
+reactor, the values are collected on each scrape from the counters the
+processes already keep (shared memory for the plants)
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import math
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+#-------------------------------------------------------------------------------
+# Constants
+
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+#-----------------------------------------------------------
+# Utilities
+
+def format_value(v):
+	"""
+	Sample value in the text format
+	"""
+	if isinstance(v, float):
+		if math.isnan(v):
+			return 'NaN'
+		if math.isinf(v):
+			return '+Inf' if v > 0 else '-Inf'
+		return repr(v)
+	return str(int(v))
+
+def format_labels(labels):
+	"""
+	Label set in the text format, empty without labels
+	"""
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+									   .replace('"', '\\"')
+									   .replace('\n', '\\n'))
+						  for k, v in labels.items()) + '}'
+
+#------------------------------------------------------------------------------
+# Exposition
+
+class Metrics():
+	"""
+	Samples of one scrape grouped by metric family, families are written in
+	the order they were first added
+	"""
+	def __init__(self):
+		#name -> [type, help, sample lines]
+		self.families = OrderedDict()
+
+	def family(self, name, kind, help):
+		f = self.families.get(name)
+		if f is None:
+			f = self.families[name] = [kind, help, []]
+		return f[2]
+
+	def counter(self, name, help, value, labels=None):
+		"""
+		Add a counter sample, name should end with _total
+		"""
+		self.family(name, 'counter', help).append('{}{} {}'.format(
+			name, format_labels(labels), format_value(value)))
+
+	def gauge(self, name, help, value, labels=None):
+		"""
+		Add a gauge sample
+		"""
+		self.family(name, 'gauge', help).append('{}{} {}'.format(
+			name, format_labels(labels), format_value(value)))
+
+	def histogram(self, name, help, hist, labels=None, scale=1):
+		"""
+		Add the samples of a scheduler.Histogram, cumulative buckets
+		:param scale multiplies the bounds and the sum (e.g. 1e-9 for ns)
+		"""
+		lines = self.family(name, 'histogram', help)
+		labels = labels or {}
+		counts = list(hist.counts)
+		acc = 0
+		for bound, c in zip(hist.bounds + (math.inf,), counts):
+			acc += c
+			le = format_value(float(bound*scale)) if bound != math.inf \
+				else '+Inf'
+			lines.append('{}_bucket{} {}'.format(
+				name, format_labels(dict(labels, le=le)), acc))
+		lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+										  format_value(hist.totals[0]*scale)))
+		lines.append('{}_count{} {}'.format(name, format_labels(labels), acc))
+
+	def text(self):
+		"""
+		Exposition text of every family
+		"""
+		out = []
+		for name, (kind, help, lines) in self.families.items():
+			out.append('# HELP {} {}'.format(name, help))
+			out.append('# TYPE {} {}'.format(name, kind))
+			out.extend(lines)
+		return '\n'.join(out) + '\n'
+
+#------------------------------------------------------------------------------
+# HTTP endpoint
+
+class MetricsResource(Resource):
+	"""
+	Twisted web resource answering every GET with a new scrape
+	"""
+	isLeaf = True
+
+	def __init__(self, collect):
+		"""
+		:param collect callable() returning the Metrics of a scrape
+		"""
+		super().__init__()
+		self.collect = collect
+
+	def render_GET(self, request):
+		request.setHeader(b'content-type', CONTENT_TYPE)
+		return self.collect().text().encode('utf-8')
+
+def listen_metrics(port, collect, interface='127.0.0.1'):
+	"""
+	Serve the metrics on the reactor, the scrapes run on the reactor thread
+	:param collect callable() returning the Metrics of a scrape
+	:return twisted listening port
+	"""
+	return reactor.listenTCP(port, Site(MetricsResource(collect)),
+							 interface=interface)
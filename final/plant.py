@@ -10,11 +10,21 @@ import sys
 import os
 import time
 import re
+import signal
+import struct
+from queue import Full, Empty
 from enum import Enum, unique, auto
-from multiprocessing import Queue
+from multiprocessing import Queue, Value, Array
 from functools import reduce
 from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.register_read_message import ReadInputRegistersRequest
+from pymodbus.register_write_message import WriteMultipleRegistersRequest
+from pymodbus.exceptions import ConnectionException
 from simple_pid import PID
+from scheduler import FixedRateScheduler, Histogram, PhaseTimer, \
+	PERIOD_BUCKETS
+from sample import Sample
+from data_log import make_sink
 import logging
 
 #-------------------------------------------------------------------------------
@@ -34,6 +44,16 @@ CTL_PAUSE = 1
 REG_IN_VALVE  = 0
 REG_OUT_VALVE = 1
 
+#holding register where the simulated tank mirrors the 4 input registers,
+#other FC23 capable servers must be given their mirror address
+REG_INPUT_MIRROR = 16
+
+#modbus exception code for a function code the server does not implement
+EX_ILLEGAL_FUNCTION = 0x01
+
+#MBAP header: transaction id, protocol id, length, unit id
+MBAP_HEADER = struct.Struct('>HHHB')
+
 #decimal offset e.g: 101 == 1.01
 DEC_OFS = 1000
 TANK_MAX_LVL = 10
@@ -41,12 +61,38 @@ TANK_MAX_LVL = 10
 #Value offset between modbus data ranges (int) 0-1000 and (float) 0.0-1.0
 V_OFS = DEC_OFS*TANK_MAX_LVL
 
+#max wait for room in the out queue with the block backpressure [s]
+PUT_TIMEOUT = 0.05
+
 
 class Plant():
 	def __init__(self, _tunings, _dest_addr, _queues,
-				 log_level=logging.DEBUG):
+				 log_level=logging.DEBUG, io_mode='single', overrun='skip',
+				 log_format='csv', log_max_bytes=None, log_max_age=None,
+				 client=None, clock=time, report=None,
+				 backpressure='drop_newest', put_timeout=PUT_TIMEOUT,
+				 input_mirror=None):
 		"""
 		Initialize PID Controller and Modbus connection
+		:param io_mode one of Plant.IOMode values, how each cycle talks to the
+		modbus server
+		:param overrun one of FixedRateScheduler.Overrun values, what the loop
+		does when a cycle takes longer than T_step
+		:param log_format data logfile format, 'csv' or 'bin'
+		:param log_max_bytes, log_max_age rotate the data logfile in
+		compressed segments of at most this size [bytes] or age [s]
+		:param client modbus client to use instead of a ModbusTcpClient to
+		_dest_addr, e.g. a tank_sim.SimulatedTankClient
+		:param clock time source with time(), monotonic() and sleep(), the time
+		module or a tank_sim.SimClock to run faster than real time
+		:param report deadband.ExceptionReport filtering the published
+		samples, every sample is published if None
+		:param backpressure one of Plant.Backpressure values, what publish
+		does when the out queue is full
+		:param put_timeout max wait for room in the out queue with the block
+		backpressure [s]
+		:param input_mirror holding register where the server mirrors the 4
+		input registers, read by the FC23 io mode (pipelined without it)
 		"""
 		#configure logging facility
 		logging.basicConfig()
@@ -55,9 +101,8 @@ class Plant():
 
 
 		self.log.info("plant setup:\n")
-		self.log.info("PID tunings: K_p:%f K_i:%f K_d:%f" % (_tunings[0],
-															 _tunings[1],
-															 _tunings[2]))
+		self.log.info("PID tunings: K_p:%f K_i:%f K_d:%f", _tunings[0],
+					  _tunings[1], _tunings[2])
 		# initialize PID Controller
 		pid = PID()
 		pid.tunings= _tunings
@@ -68,28 +113,106 @@ class Plant():
 		self.pid = pid #set pid controller object
 
 		#initialize modbus TCP Client
-		self.log.info('plant addr: {}'.format(_dest_addr))
-		self.client = ModbusTcpClient(host=_dest_addr[0], port=_dest_addr[1])
+		self.log.info('plant addr: %s', _dest_addr)
+		self.clock = clock
+		self.report = report
+		self.client = client if client is not None \
+			else self.make_client(_dest_addr)
 		self.log.info('client connected')
 
 		# Open Plant logfile
 		logdir = 'log'
-		logname = 'data_log_{}_P{:.3f}_I{:.3f}_D{:.3f}.csv'\
+		logname = 'data_log_{}_P{:.3f}_I{:.3f}_D{:.3f}'\
 		.format(int(time.time()), pid.Kp, pid.Ki, pid.Kd)
 
 		# Create 'log/' folder if it does not exist
 		if not os.path.exists('./'+logdir+'/'):
 		#if not os.path.exists('.\\'+logdir+'\\'): #for windows
 			os.mkdir(logdir)
-			self.log.info('created logdir: $s' % logdir)
-		self.logf = open((logdir+'/'+logname).encode('utf8'), 'wb')
-		self.log.info('opened logfile: %s' % logname)
+			self.log.info('created logdir: %s', logdir)
+		#opened by the plant process when run() starts
+		self.sink = make_sink(log_format, logdir+'/'+logname, log_max_bytes,
+							  log_max_age)
+		self.log.info('logfile: %s', self.sink.path)
 
 		# store output and command queues
 		self.out_q = _queues['out']
 		self.in_q =  _queues['in']
+		#optional readiness signal rung after each output sample
+		self.bell = _queues.get('bell')
+		#optional shared register image replacing the output queue
+		self.image = _queues.get('image')
+		self.backpressure = self.Backpressure(backpressure)
+		if self.backpressure == self.Backpressure.CONFLATE and \
+		   self.image is None and not getattr(self.out_q, 'conflates', False):
+			#a queue or ring can't be emptied from the producer side
+			raise ValueError('conflate backpressure needs a conflating out '
+							 'queue, e.g. shm_ring.sample_slot()')
+		self.put_timeout = put_timeout
+		#samples published and discarded by the plant (full out queue), wall
+		#time of the last published one, shared with the SoftPLC metrics
+		self.out_counts = Array('Q', 2, lock=False)
+		self.last_publish = Value('d', 0.0, lock=False)
 		self.c = 0 #reset last control signal variable
 
+		# modbus I/O mode and per cycle round trip counter
+		self.io_mode = self.IOMode(io_mode)
+		self.input_mirror = input_mirror
+		if self.io_mode == self.IOMode.FC23 and input_mirror is None:
+			#FC23 can only read holding registers, the inputs must be mirrored
+			self.log.warning('no input mirror address for FC23, using '
+							 'pipelined requests')
+			self.io_mode = self.IOMode.PIPELINED
+		self.log.info('plant io mode: %s', self.io_mode.value)
+		self.round_trips = 0
+		#valve registers written on the next batched transaction
+		self.out_regs = [0, 0]
+
+		#loop timing, the histogram is shared so it can be read at runtime
+		self.overrun = FixedRateScheduler.Overrun(overrun)
+		self.lateness = Histogram(shared=True)
+		self.periods = Histogram(PERIOD_BUCKETS, shared=True)
+		#time spent in each phase of the cycles, also shared
+		self.timing = PhaseTimer(shared=True)
+		#time the loop started, the sample times are relative to it
+		self.started = Value('d', 0.0, lock=False)
+
+	@unique
+	class IOMode(Enum):
+		"""
+		How a control cycle exchanges data with the modbus server
+		SINGLE: one request per operation (read, valve write, commands)
+		FC23: valve write and input read in one Read/Write Multiple Registers
+		      request reading the inputs from the server's holding register
+		      mirror (input_mirror), falls back to PIPELINED without a mirror
+		      address or if the server lacks FC23
+		PIPELINED: valve write (FC16) and input read (FC04) sent back to back
+		           and answered in a single round trip
+		In the batched modes valve values set during a cycle are written at
+		the start of the next one, together with the input read
+		"""
+		SINGLE = 'single'
+		FC23 = 'fc23'
+		PIPELINED = 'pipelined'
+
+	@unique
+	class Backpressure(Enum):
+		"""
+		What publishing does when the out queue is full, each policy counts
+		the samples it discards (see discarded())
+		DROP_NEWEST: discard the new sample
+		DROP_OLDEST: discard the oldest queued sample to make room, a shared
+		             memory ring is overwritten and its reader counts the loss
+		CONFLATE: the out queue is a one sample slot replaced by each publish
+		          (shm_ring.sample_slot(), see plant_pool.make_queues), the
+		          reader always gets the newest, other queues are rejected
+		BLOCK: wait up to put_timeout for room, then discard the new sample
+		"""
+		DROP_NEWEST = 'drop_newest'
+		DROP_OLDEST = 'drop_oldest'
+		CONFLATE = 'conflate'
+		BLOCK = 'block'
+
 	@unique
 	class Command(Enum):
 		"""
@@ -107,11 +230,12 @@ class Plant():
 		SET_K_I = auto()
 		SET_K_D = auto()
 		DEC_OFS = auto()
+		BATCH = auto() #arg is a tuple of (Command, arg) applied in one cycle
 
 	@unique
 	class Output(Enum):
 		"""
-		Output values
+		Output values, the fields of the Sample sent every cycle
 		"""
 		TIME = auto()
 		LEVEL = auto()
@@ -120,6 +244,7 @@ class Plant():
 		OUT_VALVE = auto()
 		SETPOINT = auto()
 		DT = auto()
+		ROUND_TRIPS = auto()
 
 	# class AutoModeEnabledException(Exception):
 	#	"""
@@ -127,24 +252,19 @@ class Plant():
 	#	"""
 	#	pass
 
-	def w_log(self, data, _first=0):
+	def make_client(self, dest_addr):
 		"""
-		Write data to logfile in csv format
-		:param data   dict in the output format
-		:param _first if 1 write the CSV header from the dict keys
+		Create the modbus client used to talk to the plant
+		:param dest_addr (host, port) tuple
 		"""
-		line = ''
-		if _first:
-			for k in data: line += '"' + str(k).split('.')[-1] +'",'
-		else:
-			for k in data.keys(): line += "{:0.4f}\t".format(data[k]);
-		self.logf.write((line+'\n').encode('utf-8'))
-		return line
+		return ModbusTcpClient(host=dest_addr[0], port=dest_addr[1])
 
-	def try_modbus_ex(self, rq):
+	def try_modbus_ex(self, rq, rtt=1):
 		"""
 		Try to run a modbus command and catch exceptions
+		:param rtt number of network round trips the request took
 		"""
+		self.round_trips += rtt
 		try:
 			assert(rq.function_code < 0x80)
 		except AttributeError as e:
@@ -198,12 +318,21 @@ class Plant():
 		self.pid.set_auto_mode(0) #disable PID controller
 		#close all valves
 		self.write_in_valve(0); self.write_out_valve(0)
+		if self.io_mode != self.IOMode.SINGLE:
+			#not left for the next exchange, the loop may be a cycle away or
+			#stopping
+			rq = self.client.write_registers(REG_IN_VALVE, self.out_regs,
+											 unit=CLP_UNIT)
+			self.try_modbus_ex(rq)
 
 	def write_in_valve(self, value):
 		"""
 		Write input valve value
 		"""
-		self.log.debug("in valve value: %i" % value)
+		self.log.debug("in valve value: %i", value)
+		if self.io_mode != self.IOMode.SINGLE:
+			self.out_regs[REG_IN_VALVE] = value #sent on the next exchange
+			return
 		rq = self.client.write_register(REG_IN_VALVE, value, unit=CLP_UNIT)
 		self.try_modbus_ex(rq) # test result
 
@@ -211,7 +340,10 @@ class Plant():
 		"""
 		Write output valve value
 		"""
-		self.log.debug("out valve value: %i" % value)
+		self.log.debug("out valve value: %i", value)
+		if self.io_mode != self.IOMode.SINGLE:
+			self.out_regs[REG_OUT_VALVE] = value #sent on the next exchange
+			return
 		rq = self.client.write_register(REG_OUT_VALVE, value, unit=CLP_UNIT)
 		self.try_modbus_ex(rq) # test result
 
@@ -220,9 +352,80 @@ class Plant():
 		Read all input registers
 		"""
 		r = self.client.read_input_registers(0, 4, unit=CLP_UNIT)
-		assert(r.function_code < 0x80)
+		self.try_modbus_ex(r)
+		return r.registers
+
+	def exchange(self):
+		"""
+		Write the pending valve registers and read all input registers in a
+		single round trip, according to the I/O mode
+		"""
+		if self.io_mode == self.IOMode.SINGLE:
+			return self.read_in_reg()
+
+		if self.io_mode == self.IOMode.FC23:
+			r = self.client.readwrite_registers(read_address=self.input_mirror,
+												read_count=4,
+												write_address=REG_IN_VALVE,
+												write_registers=self.out_regs,
+												unit=CLP_UNIT)
+			if r.isError() and \
+			   getattr(r, 'exception_code', None) == EX_ILLEGAL_FUNCTION:
+				self.round_trips += 1
+				self.log.warning('server lacks FC23, using pipelined requests')
+				self.io_mode = self.IOMode.PIPELINED
+			else:
+				self.try_modbus_ex(r)
+				return r.registers
+
+		wr, r = self.pipeline([
+			WriteMultipleRegistersRequest(REG_IN_VALVE, self.out_regs,
+										  unit=CLP_UNIT),
+			ReadInputRegistersRequest(0, 4, unit=CLP_UNIT)])
+		self.try_modbus_ex(wr, rtt=0)
+		self.try_modbus_ex(r)
 		return r.registers
 
+	def pipeline(self, requests):
+		"""
+		Send several requests back to back on the TCP connection and then
+		collect their responses, so they share one network round trip
+		:param requests list of modbus requests
+		:return list of responses in the same order as the requests
+		"""
+		client = self.client
+		if not client.is_socket_open():
+			client.connect()
+
+		packets = b''
+		for rq in requests:
+			rq.transaction_id = client.transaction.getNextTID()
+			packets += client.framer.buildPacket(rq)
+		client.send(packets)
+
+		res = {}
+		for _ in requests:
+			tid, _pid, length, _unit = \
+				MBAP_HEADER.unpack(self.recv_exact(MBAP_HEADER.size))
+			rs = client.framer.decoder.decode(self.recv_exact(length - 1))
+			rs.transaction_id = tid
+			res[tid] = rs
+		return [res[rq.transaction_id] for rq in requests]
+
+	def recv_exact(self, size):
+		"""
+		Read size bytes of a pipelined response, a short read (timeout) closes
+		the connection: the rest of the frame would desync every later
+		response, the next pipeline() reconnects
+		"""
+		data = self.client._recv(size)
+		if len(data) < size:
+			self.client.close()
+			raise ConnectionException('short read from {}: {} of {} '
+									  'bytes'.format(self.client, len(data),
+													 size))
+		return data
+
 	def set_kp(self, val):
 		"""
 		Setter for K_p
@@ -232,7 +435,7 @@ class Plant():
 			self.pid.tunings[1],
 			self.pid.tunings[2]
 			)
-		self.log.info("new tunings: {}".format(self.pid.tunings))
+		self.log.info("new tunings: %s", self.pid.tunings)
 
 	def set_ki(self, val):
 		"""
@@ -243,7 +446,7 @@ class Plant():
 			(-1*val)/DEC_OFS,
 			self.pid.tunings[2]
 			)
-		self.log.info("new tunings: {}".format(self.pid.tunings))
+		self.log.info("new tunings: %s", self.pid.tunings)
 
 	def set_kd(self, val):
 		"""
@@ -254,14 +457,14 @@ class Plant():
 			self.pid.tunings[1],
 			(-1*val)/DEC_OFS
 			)
-		self.log.info("new tunings: {}".format(self.pid.tunings))
+		self.log.info("new tunings: %s", self.pid.tunings)
 
 	def set_setpoint(self, val):
 		"""
 		Setter to be used with the command queue
 		"""
 		self.pid.setpoint = val/DEC_OFS
-		self.log.info('new setpoint %.3f' % self.pid.setpoint)
+		self.log.info('new setpoint %.3f', self.pid.setpoint)
 
 	def set_out_valve(self, val):
 		"""
@@ -269,7 +472,7 @@ class Plant():
 		"""
 		t = int(val*TANK_MAX_LVL)
 		self.c = val/DEC_OFS
-		self.log.info('set_out_valve: val: %i c: %0.2f' % (t, self.c))
+		self.log.info('set_out_valve: val: %i c: %0.2f', t, self.c)
 		if not self.pid.auto_mode:
 			self.write_out_valve(t)
 		else:
@@ -282,15 +485,96 @@ class Plant():
 		"""
 		t = int(val*TANK_MAX_LVL)
 		self.in_valve = val/DEC_OFS
-		self.log.info('set_in_valve: val: %i inv: %0.3f' % (t, self.in_valve))
+		self.log.info('set_in_valve: val: %i inv: %0.3f', t, self.in_valve)
 		self.write_in_valve(t)
 
+	def command_map(self):
+		"""
+		Mapping of commands to the functions that execute them
+		"""
+		def do_nothing(arg):
+			pass
+
+		return {
+			self.Command.STOP : self.stop ,
+			self.Command.START : self.start ,
+			self.Command.EMERGENCY : self.emergency ,
+			self.Command.AUTO_MODE : self.pid.set_auto_mode ,
+			#self.Command.TUNINGS : self.set_kp ,
+			self.Command.SETPOINT : self.set_setpoint ,
+			self.Command.IN_VALVE : self.set_in_valve ,
+			self.Command.OUT_VALVE : self.set_out_valve ,
+			self.Command.SET_K_P : self.set_kp ,
+			self.Command.SET_K_I : self.set_ki ,
+			self.Command.SET_K_D : self.set_kd ,
+			self.Command.DEC_OFS : do_nothing
+		}
+
+	def process_command(self, cmd_map):
+		"""
+		Run the next command from the input queue, if there is one, all the
+		commands of a batch are run together
+		:param cmd_map mapping from command_map()
+		"""
+		if not self.in_q.empty():
+			cmd, arg = self.in_q.get_nowait()
+			cmds = arg if cmd == self.Command.BATCH else ((cmd, arg),)
+			for cmd, arg in cmds:
+				self.log.debug("cmd: %s arg: %s", cmd, arg)
+				self.log.debug('action: %s arg:%s', cmd_map[cmd].__name__, arg)
+				cmd_map[cmd](arg)
+
+	def publish(self, res):
+		"""
+		Send an output sample to the output queue, applying the backpressure
+		policy when it is full, or to the register image, unless it is
+		suppressed by the exception report
+		"""
+		if self.report is not None and not self.report.changed(res):
+			return
+		q = self.out_q
+		if self.image is not None:
+			self.image.write(res)
+		elif self.backpressure == self.Backpressure.BLOCK:
+			try:
+				q.put(res, timeout=self.put_timeout)
+			except Full:
+				self.out_counts[1] += 1
+				self.log.error('plant: out queue is full')
+				return
+		elif q.full():
+			if self.backpressure != self.Backpressure.DROP_OLDEST:
+				self.out_counts[1] += 1
+				self.log.error('plant: out queue is full')
+				return
+			try:
+				q.get_nowait() #the reader may have emptied it meanwhile
+				self.out_counts[1] += 1
+			except Empty:
+				pass
+			q.put_nowait(res)
+		else:
+			q.put_nowait(res)
+		if self.image is None and self.bell is not None:
+			self.bell.ring()
+		self.out_counts[0] += 1
+		self.last_publish.value = self.clock.time()
+
+	def discarded(self):
+		"""
+		Samples discarded by the backpressure policy, by the plant or by an
+		out queue that drops them itself (overwriting ring, conflating slot)
+		"""
+		return self.out_counts[1] + getattr(self.out_q, 'lost', 0)
+
 	def run(self, setpoint, out_valve, in_valve, \
-			_continue_sim=0, _end_sim=0, T_scale=1, _T_step=0.300):
+			_continue_sim=0, _end_sim=0, T_scale=1, _T_step=0.300,
+			_duration=0):
 		"""
 		Main function,
 		Run simulation loop with fixed time, outputting values to a queue and
 		processing commands from a queue
+		:param _duration stop after this time [s], 0 runs forever
 		"""
 
 		# def append_l(l, n):
@@ -299,8 +583,6 @@ class Plant():
 		#local functions
 		append_l = lambda l, n: [n] + l[:-1] #append to a rolling list
 		all_is_same = lambda vec: all(el == vec[0] for el in vec)
-		def do_nothing(arg):
-			pass
 
 		#Constants
 		STOP_TIMEOUT = 1000
@@ -309,69 +591,45 @@ class Plant():
 		T_step = _T_step/T_scale #timestep adjusted for the timescale
 		pid = self.pid
 		client = self.client
-		logf = self.logf
 		self.in_valve = in_valve
 		self.pid.setpoint = setpoint
 
 		self.log.info("""
 		Simulation initial parameters
-		\tctrl: {}
-		\ttunings: {}
-		\tsetpoint: {}
-		\tin_valve: {}
-		\tout_valve: {}
-		\tT_step: {}
-		\tT_scale: {}
-		""".format(pid.auto_mode, pid.tunings, setpoint, in_valve,\
-				   out_valve, T_step, T_scale))
+		\tctrl: %s
+		\ttunings: %s
+		\tsetpoint: %s
+		\tin_valve: %s
+		\tout_valve: %s
+		\tT_step: %s
+		\tT_scale: %s
+		""", pid.auto_mode, pid.tunings, setpoint, in_valve, out_valve,
+					  T_step, T_scale)
 
 		self.pause();
-		# output object format
-		res = {
-			self.Output.TIME : 0,
-			self.Output.LEVEL : 0,
-			self.Output.OUTFLOW : 0,
-			self.Output.OUT_VALVE : 0,
-			self.Output.IN_VALVE : 0,
-			self.Output.SETPOINT : 0,
-			self.Output.DT : 0,
-		}
-
 		# mapping of commands to functions
-		cmd_map = {
-			self.Command.STOP : self.stop ,
-			self.Command.START : self.start ,
-			self.Command.EMERGENCY : self.emergency ,
-			self.Command.AUTO_MODE : self.pid.set_auto_mode ,
-			#self.Command.TUNINGS : self.set_kp ,
-			self.Command.SETPOINT : self.set_setpoint ,
-			self.Command.IN_VALVE : self.set_in_valve ,
-			self.Command.OUT_VALVE : self.set_out_valve ,
-			self.Command.SET_K_P : self.set_kp ,
-			self.Command.SET_K_I : self.set_ki ,
-			self.Command.SET_K_D : self.set_kd ,
-			self.Command.DEC_OFS : do_nothing
-		}
-
-		#vector of command number
-		cmd_values = self.Output.__members__.values()
+		cmd_map = self.command_map()
 
-		#Print logfile header if not continuing simulation
-		if not _continue_sim:
-			self.w_log(res, _first=1)
+		#Open logfile, with a new header if not continuing simulation
+		self.sink.start(_continue_sim)
 
 
 
 		#write initial values
 		self.write_in_valve(int(in_valve*V_OFS))
-		self.write_out_valve(int(c*V_OFS))
+		self.write_out_valve(int(out_valve*V_OFS))
 
 		# initialize controller with initial value
 		if pid.auto_mode: pid.set_auto_mode(True, out_valve)
 
 		#start simulation and unpause
 		self.start(); self.unpause()
-		last_t = time.time(); start_t = last_t
+		start_t = self.clock.time()
+		self.started.value = start_t
+		sched = FixedRateScheduler(T_step, self.overrun, self.lateness,
+								   clock=self.clock.monotonic,
+								   sleep=self.clock.sleep,
+								   periods=self.periods)
 
 		#Initialize Simulation Loop variables
 		level = 0
@@ -379,58 +637,61 @@ class Plant():
 		pid.setpoint = setpoint
 		c = out_valve
 		last_c = None
-		dt = 0
-		sleep_t = 0
-
-		#simulation loop
-		while True:
-			last_t = time.time()
-
-			#Read input values
-			level, outflow, setpoint, T_scale = self.read_in_reg()
-			level /= V_OFS #scale down values from 0-1000 -> 0.0-1.0
-
-			#check if controller enabled/not enabled
-			if pid.auto_mode:
-				self.c = pid(level)
-				if self.c != last_c:
-					#write control signal
-					self.write_out_valve(int(self.c*V_OFS))
-					last_c = self.c
-
-			#assemble output object
-			res = {
-				self.Output.TIME      : time.time() - start_t,
-				self.Output.LEVEL     : level,
-				self.Output.OUTFLOW   : outflow/V_OFS,
-				self.Output.OUT_VALVE : self.c,
-				self.Output.IN_VALVE  : self.in_valve,
-				self.Output.SETPOINT  : self.pid.setpoint,
-				self.Output.DT        : dt+sleep_t,
-			}
-			line = self.w_log(res) #write CSV log line
-			#send to output queue
-			if not self.out_q.full():
-				self.out_q.put_nowait(res)
-			else:
-				self.log.error('plant: out queue is full')
-			self.log.info(line)
-
-			#try reading input commands
-			if not self.in_q.empty():
-				cmd, arg = self.in_q.get_nowait()
-				self.log.debug("cmd: {} arg: {}".format(cmd, arg))
-				if 1 or cmd in cmd_values:
-					self.log.debug('action: {} arg:{}'.format(cmd_map[cmd], arg))
-					cmd_map[cmd](arg)
-
-			dt = (time.time() - last_t)
-			#Delay at most T_step
-			if dt < T_step:
-				sleep_t = T_step - dt
-				time.sleep(sleep_t)
-
-		#used if the sym loop has a end condition, not used right now
+		timing = self.timing
+		overruns = sched.overruns
+
+		#flush the data log when the process is terminated
+		signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+		timing.start()
+		try:
+			#simulation loop
+			while True:
+				self.round_trips = 0
+
+				#Read input values (and write valves set on the previous cycle
+				#when batching I/O)
+				level, outflow, setpoint, T_scale = self.exchange()
+				level /= V_OFS #scale down values from 0-1000 -> 0.0-1.0
+				timing.mark('read')
+
+				#check if controller enabled/not enabled
+				if pid.auto_mode:
+					#time step from the loop clock, which may be virtual
+					self.c = pid(level, dt=sched.last_period or T_step)
+					timing.mark('pid')
+					if self.c != last_c:
+						#write control signal
+						self.write_out_valve(int(self.c*V_OFS))
+						last_c = self.c
+						timing.mark('write')
+
+				#try reading input commands
+				self.process_command(cmd_map)
+				timing.mark('command')
+
+				#assemble output object
+				res = Sample(self.clock.time() - start_t, level, outflow/V_OFS,
+							 self.c, self.in_valve, self.pid.setpoint,
+							 sched.last_period, self.round_trips)
+				self.sink.write(res) #write data log
+				self.log.debug('sample: %s', res)
+				timing.mark('log')
+				self.publish(res) #send to output queue
+				timing.mark('publish')
+
+				if _duration and res.time >= _duration:
+					break
+
+				#sleep until the next deadline
+				sched.wait()
+				timing.mark('sleep')
+				timing.end_cycle(sched.overruns != overruns)
+				overruns = sched.overruns
+		finally:
+			self.sink.close()
+			self.log.info('plant loop phases mean/max [ms]: %s', timing.summary())
+
+		#used if the sym loop has a end condition
 		if _end_sim:
 			self.stop()
 		else:
@@ -0,0 +1,177 @@
+#!/bin/python
+"""
+Pool of plant processes supervised from the SoftPLC process
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import json
+import time
+from multiprocessing import Queue, Process
+from shm_ring import sample_ring, sample_slot, command_ring
+from doorbell import Doorbell
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#minimum time between two restarts of the same worker [s]
+RESTART_BACKOFF = 5
+
+#-----------------------------------------------------------
+# Plant specs
+
+def plant_spec(host, port, tunings, unit=0, setpoint=0, out_valve=0,
+			   in_valve=0):
+	"""
+	Description of one plant worker
+	:param host, port plant modbus server address
+	:param tunings (K_p, K_i, K_d)
+	:param unit modbus unit id of the plant registers on the SoftPLC server
+	:param setpoint, out_valve, in_valve initial values passed to Plant.run
+	"""
+	return {
+		'host': host, 'port': port, 'tunings': tuple(tunings), 'unit': unit,
+		'setpoint': setpoint, 'out_valve': out_valve, 'in_valve': in_valve,
+	}
+
+def load_plant_specs(path, host, port, tunings):
+	"""
+	Read plant specs from a JSON file holding a list of objects with the
+	plant_spec() keys, missing keys take the given defaults and units are
+	numbered from 1 in file order, e.g.
+	[{"host": "192.168.0.10", "port": 502, "unit": 1},
+	 {"host": "192.168.0.11", "tunings": [-5, -1.517, -13.593]}]
+	"""
+	with open(path) as f:
+		entries = json.load(f)
+	return [plant_spec(**dict({'host': host, 'port': port,
+							   'tunings': tunings, 'unit': i+1}, **e))
+			for i, e in enumerate(entries)]
+
+def parse_plant_arg(arg, port):
+	"""
+	Parse a host[:port] command line plant address
+	"""
+	host, _, p = arg.partition(':')
+	return host, int(p) if p else port
+
+def make_queues(transport, q_len, doorbell=False, backpressure='drop_newest'):
+	"""
+	Plant input and output queues
+	:param transport 'queue' for multiprocessing queues or 'shm' for shared
+	memory rings
+	:param doorbell add a Doorbell rung by the plant on every output sample
+	:param backpressure Plant.Backpressure value of the plant, 'conflate'
+	makes the output a one sample slot and 'drop_oldest' an overwriting ring
+	with the shm transport
+	"""
+	if backpressure == 'conflate':
+		out_q = sample_slot()
+	elif transport == 'shm':
+		out_q = sample_ring(q_len, backpressure == 'drop_oldest')
+	else:
+		out_q = Queue(q_len)
+	in_q = command_ring(q_len) if transport == 'shm' else Queue(q_len)
+	queues = { 'out':out_q, 'in':in_q }
+	if doorbell:
+		queues['bell'] = Doorbell()
+	return queues
+
+#------------------------------------------------------------------------------
+# Pool
+
+class PlantPool():
+	"""
+	Start one process per plant spread across the CPU cores and restart the
+	ones that die, each worker keeps its own input and output queues
+	"""
+	def __init__(self, specs, plant_factory, q_len, log, transport='queue',
+				 doorbell=False, backpressure='drop_newest'):
+		"""
+		:param specs list of plant_spec()
+		:param plant_factory callable(spec, queues) returning a Plant
+		:param q_len length of each worker queue
+		:param transport plant queues type, see make_queues()
+		:param doorbell give every worker a Doorbell, see make_queues()
+		:param backpressure output queue type for the plants backpressure
+		policy, see make_queues()
+		"""
+		self.log = log
+		self.cpus = sorted(os.sched_getaffinity(0)) \
+			if hasattr(os, 'sched_getaffinity') else []
+		self.workers = []
+		for spec in specs:
+			queues = make_queues(transport, q_len, doorbell, backpressure)
+			self.workers.append({
+				'spec': spec,
+				'queues': queues,
+				'plant': plant_factory(spec, queues),
+				'proc': None,
+				'cpu': None,
+				'started': 0,
+				'restarts': 0,
+			})
+
+	def least_loaded_cpu(self):
+		"""
+		CPU with the fewest running workers
+		"""
+		load = dict.fromkeys(self.cpus, 0)
+		for w in self.workers:
+			if w['proc'] is not None and w['proc'].is_alive() \
+			   and w['cpu'] in load:
+				load[w['cpu']] += 1
+		return min(load, key=load.get) if load else None
+
+	def start_worker(self, w, _continue_sim=0):
+		"""
+		Start a worker process and pin it to the least loaded CPU
+		"""
+		spec = w['spec']
+		w['cpu'] = None
+		cpu = self.least_loaded_cpu()
+		w['proc'] = Process(target=w['plant'].run,
+							name='plant-{}'.format(spec['unit']),
+							args=(spec['setpoint'], spec['out_valve'],
+								  spec['in_valve'], _continue_sim))
+		w['proc'].start()
+		w['started'] = time.monotonic()
+		if cpu is not None:
+			os.sched_setaffinity(w['proc'].pid, {cpu})
+			w['cpu'] = cpu
+		self.log.info('plant %i (%s:%i) started, pid %i cpu %s', spec['unit'],
+					  spec['host'], spec['port'], w['proc'].pid, w['cpu'])
+
+	def start(self):
+		"""
+		Start all workers
+		"""
+		for w in self.workers:
+			self.start_worker(w)
+
+	def supervise(self):
+		"""
+		Restart dead workers, call periodically
+		"""
+		now = time.monotonic()
+		for w in self.workers:
+			if w['proc'].is_alive() or now - w['started'] < RESTART_BACKOFF:
+				continue
+			w['restarts'] += 1
+			self.log.error('plant %i died with exit code %s, restart %i',
+						   w['spec']['unit'], w['proc'].exitcode, w['restarts'])
+			self.start_worker(w, _continue_sim=1)
+
+	def stop(self):
+		"""
+		Terminate all workers and release their queues
+		"""
+		for w in self.workers:
+			if w['proc'] is not None and w['proc'].is_alive():
+				w['proc'].terminate()
+				w['proc'].join()
+			for q in w['queues'].values():
+				if hasattr(q, 'close'):
+					q.close()
@@ -0,0 +1,96 @@
+#!/bin/python
+"""
+Double buffered image of the plant output registers in shared memory, the
+plant writes every sample to it and the modbus server serves the published
+snapshot
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#sequence number of the published buffer (buffer seq & 1), 0 before the
+#first snapshot
+HEADER = struct.Struct('<Q')
+
+#------------------------------------------------------------------------------
+# Register image
+
+class RegisterImage():
+	"""
+	Two copies of the output registers of a TagDB (its blocks, packed one
+	after the other). The writer fills the unpublished copy and publishes it
+	by incrementing the sequence number, a reader copies from the published
+	one and retries if the sequence changed meanwhile, so it always gets the
+	registers of a single sample. One writer, must be created before the
+	processes are started.
+	"""
+	def __init__(self, tags):
+		"""
+		:param tags TagDB of the registers
+		"""
+		self.tags = tags
+		#(area, start address, count, offset in the image)
+		self.blocks = []
+		n = 0
+		for area, start, fields in tags.blocks:
+			self.blocks.append((area, start, len(fields), n))
+			n += len(fields)
+		self.size = n
+		self.shm = shared_memory.SharedMemory(
+			create=True, size=HEADER.size + 2*2*max(n, 1))
+		self.seq = self.shm.buf[:HEADER.size].cast('Q')
+		self.seq[0] = 0
+		data = self.shm.buf[HEADER.size:]
+		self.bufs = [data[:2*n].cast('H'), data[2*n:4*n].cast('H')]
+
+	def write(self, sample):
+		"""
+		Publish the registers of a Sample, writer side
+		"""
+		seq = self.seq[0]
+		buf = self.bufs[(seq + 1) & 1]
+		for (_, _, values), (_, _, n, ofs) in zip(self.tags.outputs(sample),
+												   self.blocks):
+			#16 bit registers, negative values in two's complement
+			buf[ofs:ofs+n] = array('H', [v & 0xffff for v in values])
+		self.seq[0] = seq + 1 #publish
+
+	def overlay(self, area, address, values):
+		"""
+		Replace the registers of the image in a list of register values,
+		reader side
+		:param address address of values[0]
+		:return values
+		"""
+		while True:
+			seq = self.seq[0]
+			if seq == 0:
+				return values #nothing published yet
+			buf = self.bufs[seq & 1]
+			for b_area, start, n, ofs in self.blocks:
+				lo = max(address, start)
+				hi = min(address + len(values), start + n)
+				if b_area == area and lo < hi:
+					values[lo-address:hi-address] = \
+						buf[ofs+lo-start:ofs+hi-start].tolist()
+			#the writer reuses this buffer after the next flip
+			if self.seq[0] == seq:
+				return values
+
+	def close(self):
+		"""
+		Release the shared memory, call from the creating process on exit
+		"""
+		self.seq.release()
+		for b in self.bufs:
+			b.release()
+		self.seq = self.bufs = None #drop the views of shm.buf
+		self.shm.close()
+		self.shm.unlink()
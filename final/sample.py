@@ -0,0 +1,119 @@
+#!/bin/python
+"""
+Fixed layout plant output sample
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import struct
+from array import array
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#sample fields, in logfile column order
+FIELDS = ('time', 'level', 'outflow', 'out_valve', 'in_valve', 'setpoint',
+		  'dt', 'round_trips')
+
+#------------------------------------------------------------------------------
+# Sample
+
+class Sample():
+	"""
+	One plant cycle output, packs to SIZE bytes (little endian doubles in
+	FIELDS order)
+	"""
+	__slots__ = FIELDS
+	STRUCT = struct.Struct('<{}d'.format(len(FIELDS)))
+	SIZE = STRUCT.size
+
+	def __init__(self, time=0.0, level=0.0, outflow=0.0, out_valve=0.0,
+				 in_valve=0.0, setpoint=0.0, dt=0.0, round_trips=0):
+		self.time = time
+		self.level = level
+		self.outflow = outflow
+		self.out_valve = out_valve
+		self.in_valve = in_valve
+		self.setpoint = setpoint
+		self.dt = dt
+		self.round_trips = round_trips
+
+	def fields(self):
+		"""
+		Values in FIELDS order
+		"""
+		return (self.time, self.level, self.outflow, self.out_valve,
+				self.in_valve, self.setpoint, self.dt, self.round_trips)
+
+	def __iter__(self):
+		return iter(self.fields())
+
+	def __getitem__(self, output):
+		"""
+		Access by Plant.Output member
+		"""
+		return getattr(self, output.name.lower())
+
+	def __eq__(self, other):
+		return isinstance(other, Sample) and self.fields() == other.fields()
+
+	def __reduce__(self):
+		return (Sample, self.fields())
+
+	def __repr__(self):
+		return 'Sample({})'.format(', '.join(
+			'{}={}'.format(f, v) for f, v in zip(FIELDS, self.fields())))
+
+	def pack(self):
+		return self.STRUCT.pack(*self.fields())
+
+	def pack_into(self, buf, offset=0):
+		self.STRUCT.pack_into(buf, offset, *self.fields())
+
+	@classmethod
+	def unpack(cls, buf):
+		return cls(*cls.STRUCT.unpack(buf))
+
+	@classmethod
+	def unpack_from(cls, buf, offset=0):
+		return cls(*cls.STRUCT.unpack_from(buf, offset))
+
+#------------------------------------------------------------------------------
+# Batches
+
+class SampleBatch():
+	"""
+	Array of samples stored row by row in a flat array of doubles, on little
+	endian machines the bytes are the packed samples one after the other
+	"""
+	def __init__(self, data=b''):
+		"""
+		:param data packed samples
+		"""
+		self.values = array('d')
+		self.values.frombytes(data)
+
+	def __len__(self):
+		return len(self.values)//len(FIELDS)
+
+	def __getitem__(self, i):
+		n = len(FIELDS)
+		if i < 0:
+			i += len(self)
+		return Sample(*self.values[i*n:(i+1)*n])
+
+	def __iter__(self):
+		return (self[i] for i in range(len(self)))
+
+	def append(self, sample):
+		self.values.extend(sample.fields())
+
+	def column(self, field):
+		"""
+		All the values of one field
+		"""
+		return self.values[FIELDS.index(field)::len(FIELDS)]
+
+	def tobytes(self):
+		return self.values.tobytes()
@@ -0,0 +1,335 @@
+#!/bin/python
+"""
+Fixed rate scheduler with absolute deadlines, lateness statistics and
+per phase timing of the control cycles
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import time
+import math
+from bisect import bisect_left
+from enum import Enum, unique
+from multiprocessing import Array
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#lateness histogram bucket upper bounds [s]
+LATENESS_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+					0.1, 0.2, 0.5, 1.0)
+#loop period histogram bucket upper bounds [s]
+PERIOD_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+				  2.0, 5.0, 10.0)
+#cycle phase duration histogram bucket upper bounds [ns]
+PHASE_BUCKETS = (1000, 5000, 10000, 50000, 100000, 500000, 1000000, 2000000,
+				 5000000, 10000000, 20000000, 50000000, 100000000, 200000000,
+				 500000000, 1000000000)
+#phases of a plant control cycle, in execution order
+PHASES = ('read', 'pid', 'write', 'command', 'log', 'publish', 'sleep')
+#cycles of a rolling phase histogram window
+PHASE_WINDOW = 200
+
+#------------------------------------------------------------------------------
+# Histogram
+
+class Histogram():
+	"""
+	Fixed bucket histogram, when shared the counts live in shared memory so
+	a process can read the histogram while another one fills it
+	"""
+	def __init__(self, bounds=LATENESS_BUCKETS, shared=False):
+		"""
+		:param bounds sorted bucket upper bounds, values above the last one
+		go to an overflow bucket
+		:param shared allocate the counters in shared memory, must be created
+		before the writer process is started
+		"""
+		self.bounds = tuple(bounds)
+		n = len(self.bounds) + 1
+		if shared:
+			#single writer, readers tolerate a value being updated
+			self.counts = Array('Q', n, lock=False)
+			self.totals = Array('d', 2, lock=False) #sum, max
+		else:
+			self.counts = [0]*n
+			self.totals = [0.0, 0.0]
+
+	def add(self, v):
+		"""
+		Count a value
+		"""
+		self.counts[bisect_left(self.bounds, v)] += 1
+		self.totals[0] += v
+		if v > self.totals[1]:
+			self.totals[1] = v
+
+	def reset(self):
+		"""
+		Clear the counts
+		"""
+		for i in range(len(self.counts)):
+			self.counts[i] = 0
+		self.totals[0] = self.totals[1] = 0
+
+	def quantile(self, q, counts=None):
+		"""
+		Upper bound of the bucket holding the q quantile (inf if it is in the
+		overflow bucket)
+		"""
+		counts = list(self.counts) if counts is None else counts
+		rank = q*sum(counts)
+		acc = 0
+		for i, c in enumerate(counts):
+			acc += c
+			if c and acc >= rank:
+				return self.bounds[i] if i < len(self.bounds) else math.inf
+		return 0.0
+
+	def snapshot(self):
+		"""
+		Copy of the current state as a dict
+		"""
+		counts = list(self.counts)
+		n = sum(counts)
+		return {
+			'buckets': dict(zip(self.bounds + (math.inf,), counts)),
+			'count': n,
+			'mean': self.totals[0]/n if n else 0.0,
+			'max': self.totals[1],
+			'p50': self.quantile(0.50, counts),
+			'p99': self.quantile(0.99, counts),
+		}
+
+	def summary(self):
+		"""
+		One line text summary
+		"""
+		s = self.snapshot()
+		return 'n: {} mean: {:.6f} p50: <={} p99: <={} max: {:.6f}'.format(
+			s['count'], s['mean'], s['p50'], s['p99'], s['max'])
+
+#------------------------------------------------------------------------------
+# Phase timing
+
+class PhaseTimer():
+	"""
+	Duration of each phase of a control cycle from a monotonic ns clock. The
+	cycle calls mark(phase) at the end of each phase (a phase may run several
+	times per cycle) and end_cycle() once, which counts the phase durations in
+	a histogram since start and in rolling windows of PHASE_WINDOW cycles.
+	The phase durations of the busiest cycle (longest outside the sleep
+	phase) and of the last cycle that overran its deadline are kept too. When
+	shared everything lives in shared memory so another process can read it
+	while the loop runs.
+	"""
+	def __init__(self, phases=PHASES, window=PHASE_WINDOW, shared=False,
+				 clock=time.monotonic_ns):
+		"""
+		:param phases phase names
+		:param window cycles of a rolling window
+		:param shared allocate the counters in shared memory, must be created
+		before the writer process is started
+		:param clock monotonic time source [ns]
+		"""
+		self.phases = tuple(phases)
+		self.index = { p: i for i, p in enumerate(self.phases) }
+		self.window = window
+		self.clock = clock
+		self.total = [Histogram(PHASE_BUCKETS, shared) for p in self.phases]
+		#the writer fills windows[active], readers get the other one
+		self.windows = [[Histogram(PHASE_BUCKETS, shared)
+						 for p in self.phases] for _ in range(2)]
+		n = len(self.phases)
+		if shared:
+			self.state = Array('Q', 3, lock=False)
+			#phase durations followed by the busy time [ns]
+			self.worst = Array('Q', n + 1, lock=False)
+			self.last_overrun = Array('Q', n + 1, lock=False)
+		else:
+			self.state = [0]*3 #active window, cycles in it, overruns
+			self.worst = [0]*(n + 1)
+			self.last_overrun = [0]*(n + 1)
+		self.cycle = [0]*n
+		self.t = 0
+
+	def start(self):
+		"""
+		Mark the start of the first cycle
+		"""
+		self.t = self.clock()
+		self.cycle = [0]*len(self.phases)
+
+	def mark(self, phase):
+		"""
+		End of a phase, the time since the previous mark is counted to it
+		"""
+		now = self.clock()
+		self.cycle[self.index[phase]] += now - self.t
+		self.t = now
+
+	def end_cycle(self, overrun=False):
+		"""
+		Count the phase durations of the cycle that just ended
+		:param overrun the cycle ended after its deadline
+		"""
+		cycle = self.cycle
+		active, n = self.state[0], self.state[1]
+		window = self.windows[active]
+		for d, h, w in zip(cycle, self.total, window):
+			h.add(d)
+			w.add(d)
+		busy = sum(cycle) - (cycle[self.index['sleep']]
+							 if 'sleep' in self.index else 0)
+		if busy > self.worst[-1]:
+			self.worst[:] = cycle + [busy]
+		if overrun:
+			self.last_overrun[:] = cycle + [busy]
+			self.state[2] += 1
+		n += 1
+		if n >= self.window:
+			#start over on the window the readers had, they get this one now
+			for h in self.windows[1 - active]:
+				h.reset()
+			self.state[0] = 1 - active
+			n = 0
+		self.state[1] = n
+		self.cycle = [0]*len(self.phases)
+
+	@property
+	def overruns(self):
+		return self.state[2]
+
+	def recent(self):
+		"""
+		Histograms of the last complete window, the one being filled until
+		the first window is complete
+		"""
+		active = self.state[0]
+		last = self.windows[1 - active]
+		return last if sum(last[0].counts) else self.windows[active]
+
+	def snapshot(self):
+		"""
+		Copy of the current state as a dict, durations in ns
+		:return dict with the total and recent() window histogram snapshots
+		of each phase, the busiest and last overrun cycles as dicts of
+		phase -> duration and the overrun count
+		"""
+		recent = self.recent()
+		names = self.phases + ('busy',)
+		return {
+			'total': { p: h.snapshot()
+					   for p, h in zip(self.phases, self.total) },
+			'window': { p: h.snapshot() for p, h in zip(self.phases, recent) },
+			'busiest': dict(zip(names, self.worst)),
+			'last_overrun': dict(zip(names, self.last_overrun)),
+			'overruns': self.overruns,
+		}
+
+	def summary(self, window=False):
+		"""
+		One line text summary, mean/max of each phase and the phases of the
+		busiest and last overrun cycles [ms]
+		:param window summarize the recent() window instead of the total
+		"""
+		hists = self.recent() if window else self.total
+		cycle = lambda durations: ' '.join('{}={:.3f}'.format(p, d/1e6)
+			for p, d in zip(self.phases + ('busy',), durations))
+		phases = []
+		for p, h in zip(self.phases, hists):
+			s = h.snapshot()
+			phases.append('{}: {:.3f}/{:.3f}'.format(p, s['mean']/1e6,
+													 s['max']/1e6))
+		res = [' '.join(phases), 'busiest cycle: ' + cycle(self.worst)]
+		if self.overruns:
+			res.append('last overrun of {}: {}'.format(
+				self.overruns, cycle(self.last_overrun)))
+		return ', '.join(res)
+
+#------------------------------------------------------------------------------
+# Scheduler
+
+class FixedRateScheduler():
+	"""
+	Wake up on absolute deadlines start + k*period of a monotonic clock, so
+	the time spent in each cycle does not make the period drift
+	"""
+	@unique
+	class Overrun(Enum):
+		"""
+		What to do when a cycle ends after the next deadline
+		SKIP: drop the missed deadlines and wait for the next one on the grid
+		CATCH_UP: run the missed cycles back to back until on time again
+		STRETCH: start the next cycle now and move the grid with it
+		"""
+		SKIP = 'skip'
+		CATCH_UP = 'catch_up'
+		STRETCH = 'stretch'
+
+	def __init__(self, period, overrun='skip', histogram=None,
+				 clock=time.monotonic, sleep=time.sleep, periods=None):
+		"""
+		:param period cycle period [s]
+		:param overrun one of FixedRateScheduler.Overrun values
+		:param histogram Histogram where the lateness of each cycle is counted
+		:param clock, sleep time source and delay function
+		:param periods Histogram where the measured period of each cycle is
+		counted
+		"""
+		self.period = period
+		self.overrun = self.Overrun(overrun)
+		self.lateness = histogram if histogram is not None else Histogram()
+		self.periods = periods
+		self.clock = clock
+		self.sleep = sleep
+		self.overruns = 0 #cycles that ended after the next deadline
+		self.missed = 0 #deadlines skipped
+		self.start()
+
+	def start(self):
+		"""
+		(Re)start the deadline grid at the current time
+		"""
+		self.deadline = self.clock()
+		self.due = self.deadline
+		self.cycle_t = self.deadline
+		self.last_period = 0
+
+	def advance(self):
+		"""
+		Move to the next deadline applying the overrun policy
+		:return time to sleep until it [s]
+		"""
+		self.deadline += self.period
+		self.due = self.deadline
+		now = self.clock()
+		if now > self.deadline:
+			self.overruns += 1
+			if self.overrun == self.Overrun.SKIP:
+				n = math.ceil((now - self.deadline)/self.period)
+				self.missed += n
+				self.deadline += n*self.period
+			elif self.overrun == self.Overrun.STRETCH:
+				self.deadline = now
+		return max(0.0, self.deadline - now)
+
+	def tick(self):
+		"""
+		Mark the start of a cycle, recording how late it is compared to the
+		deadline it should have started on before any overrun handling
+		"""
+		now = self.clock()
+		self.lateness.add(max(0.0, now - self.due))
+		self.last_period = now - self.cycle_t
+		self.cycle_t = now
+		if self.periods is not None:
+			self.periods.add(self.last_period)
+
+	def wait(self):
+		"""
+		Sleep until the next deadline, call at the end of each cycle
+		"""
+		self.sleep(self.advance())
+		self.tick()
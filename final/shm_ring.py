@@ -0,0 +1,335 @@
+#!/bin/python
+"""
+Single producer, single consumer ring buffer and conflating slot in shared
+memory, used as lock free transports between the plant and the SoftPLC
+processes
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import time
+import struct
+from queue import Full, Empty
+from multiprocessing import shared_memory
+
+from plant import Plant
+from sample import Sample
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#head (next slot written by the producer), tail (next slot read by the
+#consumer), records lost to the producer overwriting them (consumer written)
+HEADER = struct.Struct('<QQQ')
+#slot header: sequence (odd while the producer writes), sequence of the last
+#sample read (consumer written), samples replaced before being read
+SLOT_HEADER = struct.Struct('<QQQ')
+#poll interval of a blocking put [s]
+PUT_POLL = 0.001
+
+#command record: command value, argument
+COMMAND_RECORD = struct.Struct('<Iq')
+
+#------------------------------------------------------------------------------
+# Ring buffer
+
+class ShmRing():
+	"""
+	Fixed size records in a shared memory ring, the producer only writes the
+	head counter and the consumer only writes the tail counter so no lock is
+	needed. Relies on aligned 8 byte stores being atomic and not reordered
+	(x86), must be created before the processes are started.
+
+	Has the non blocking part of the multiprocessing.Queue interface so it
+	can replace the plant queues.
+
+	In overwrite mode the producer never waits: a full ring loses its oldest
+	records. The consumer detects the records it was lapped on (and one more
+	slot, the one the producer may be writing), skips and counts them in lost.
+	"""
+	def __init__(self, record, capacity, pack, unpack, overwrite=False):
+		"""
+		:param record struct.Struct of one record
+		:param capacity number of records
+		:param pack callable(obj) returning the record fields
+		:param unpack callable(fields) returning the obj
+		:param overwrite drop the oldest records instead of being full
+		"""
+		self.record = record
+		self.capacity = capacity
+		self.pack = pack
+		self.unpack = unpack
+		self.overwrite = overwrite
+		self.shm = shared_memory.SharedMemory(
+			create=True, size=HEADER.size + record.size*capacity)
+		self.idx = self.shm.buf[:HEADER.size].cast('Q')
+		self.idx[0] = 0
+		self.idx[1] = 0
+		self.idx[2] = 0
+		self.data = self.shm.buf[HEADER.size:]
+
+	def offset(self, n):
+		"""
+		Byte offset of record number n
+		"""
+		return (n % self.capacity)*self.record.size
+
+	def qsize(self):
+		n = self.idx[0] - self.idx[1]
+		return min(n, self.capacity - 1) if self.overwrite else n
+
+	def empty(self):
+		return self.idx[0] == self.idx[1]
+
+	def full(self):
+		return not self.overwrite and \
+			self.idx[0] - self.idx[1] >= self.capacity
+
+	@property
+	def lost(self):
+		"""
+		Records overwritten before being read
+		"""
+		return self.idx[2]
+
+	def put_records_nowait(self, records):
+		"""
+		Append several records at once, the consumer sees all or none of them,
+		producer side
+		:param records list of record fields
+		"""
+		head = self.idx[0]
+		if not self.overwrite and \
+		   head + len(records) - self.idx[1] > self.capacity:
+			raise Full
+		for i, fields in enumerate(records):
+			self.record.pack_into(self.data, self.offset(head + i), *fields)
+		self.idx[0] = head + len(records) #publish
+
+	def put_nowait(self, obj):
+		"""
+		Append a record, producer side
+		"""
+		self.put_records_nowait([self.pack(obj)])
+
+	def put(self, obj, block=True, timeout=None):
+		"""
+		Append a record, waiting up to timeout [s] for a free slot, producer
+		side
+		"""
+		end = None if timeout is None else time.monotonic() + timeout
+		while block and self.full():
+			if end is not None and time.monotonic() >= end:
+				break
+			time.sleep(PUT_POLL)
+		self.put_nowait(obj)
+
+	def skip_lapped(self, tail, head):
+		"""
+		First readable record in overwrite mode, counting the lost ones
+		"""
+		#the producer may be writing the slot of head - capacity
+		oldest = head - self.capacity + 1
+		if tail < oldest:
+			self.idx[2] += oldest - tail
+			return oldest
+		return tail
+
+	def read(self, n):
+		"""
+		Copy of the fields of record number n, None if it was overwritten
+		meanwhile
+		"""
+		fields = self.record.unpack_from(self.data, self.offset(n))
+		if self.overwrite and self.idx[0] - n >= self.capacity:
+			return None
+		return fields
+
+	def get_nowait(self):
+		"""
+		Pop the oldest record, consumer side
+		"""
+		tail = self.idx[1]
+		while True:
+			head = self.idx[0]
+			if tail == head:
+				raise Empty
+			if self.overwrite:
+				tail = self.skip_lapped(tail, head)
+			fields = self.read(tail)
+			if fields is not None:
+				break
+		self.idx[1] = tail + 1 #release the slot
+		return self.unpack(fields)
+
+	def latest(self):
+		"""
+		Return the newest record and discard the older ones, consumer side
+		:return the record or None if the ring is empty
+		"""
+		while True:
+			head = self.idx[0]
+			if head == self.idx[1]:
+				return None
+			if self.overwrite:
+				self.skip_lapped(self.idx[1], head)
+			#the producer can't reach this slot before the tail moves past
+			#it, unless overwriting
+			fields = self.read(head - 1)
+			if fields is not None:
+				break
+		self.idx[1] = head
+		return self.unpack(fields)
+
+	def close(self):
+		"""
+		Release the shared memory, call from the creating process on exit
+		"""
+		self.idx.release()
+		self.data.release()
+		self.shm.close()
+		self.shm.unlink()
+
+class CommandRing(ShmRing):
+	"""
+	Ring of (Plant.Command, arg) tuples, a Command.BATCH is stored as a
+	(BATCH, count) record followed by its commands and published at once.
+	qsize() and full() count records, not commands.
+	"""
+	def __init__(self, capacity):
+		super().__init__(COMMAND_RECORD, capacity,
+						 lambda cmd: (cmd[0].value, int(cmd[1])),
+						 lambda rec: (Plant.Command(rec[0]), rec[1]))
+
+	def put_nowait(self, cmd):
+		if cmd[0] == Plant.Command.BATCH:
+			self.put_records_nowait([(cmd[0].value, len(cmd[1]))] +
+									[self.pack(c) for c in cmd[1]])
+		else:
+			self.put_records_nowait([self.pack(cmd)])
+
+	def get_nowait(self):
+		tail = self.idx[1]
+		if tail == self.idx[0]:
+			raise Empty
+		cmd = self.unpack(self.record.unpack_from(self.data, self.offset(tail)))
+		n = 1
+		if cmd[0] == Plant.Command.BATCH:
+			n += cmd[1]
+			cmd = (cmd[0], tuple(
+				self.unpack(self.record.unpack_from(self.data,
+													self.offset(tail + i)))
+				for i in range(1, n)))
+		self.idx[1] = tail + n #release the slots
+		return cmd
+
+#------------------------------------------------------------------------------
+# Conflating slot
+
+class SampleSlot():
+	"""
+	One Sample in shared memory replaced by each put, so the consumer always
+	gets the newest one and the memory is bounded whatever the consumer
+	does. The producer marks the slot as being written with an odd sequence
+	number (a seqlock), the consumer retries a copy that raced a write and
+	acknowledges what it read, so the producer can count the samples it
+	replaced unread. Same interface as a ShmRing, never full.
+	"""
+	#replaces the unread sample itself, see Plant.Backpressure.CONFLATE
+	conflates = True
+
+	def __init__(self):
+		self.record = Sample.STRUCT
+		self.shm = shared_memory.SharedMemory(
+			create=True, size=SLOT_HEADER.size + self.record.size)
+		self.idx = self.shm.buf[:SLOT_HEADER.size].cast('Q')
+		self.idx[0] = 0
+		self.idx[1] = 0
+		self.idx[2] = 0
+		self.data = self.shm.buf[SLOT_HEADER.size:]
+
+	def qsize(self):
+		return 0 if self.idx[0] == self.idx[1] else 1
+
+	def empty(self):
+		return self.idx[0] == self.idx[1]
+
+	def full(self):
+		return False
+
+	@property
+	def lost(self):
+		"""
+		Samples replaced before being read, may count one that was read
+		while it was being replaced
+		"""
+		return self.idx[2]
+
+	def put_nowait(self, sample):
+		"""
+		Replace the sample, producer side
+		"""
+		seq = self.idx[0]
+		if seq and self.idx[1] != seq:
+			self.idx[2] += 1
+		self.idx[0] = seq + 1 #writing
+		self.record.pack_into(self.data, 0, *sample.fields())
+		self.idx[0] = seq + 2 #publish
+
+	def put(self, sample, block=True, timeout=None):
+		self.put_nowait(sample)
+
+	def latest(self):
+		"""
+		The sample if it was not read yet, consumer side
+		:return the sample or None
+		"""
+		while True:
+			seq = self.idx[0]
+			#nothing new, or being written: picked up on the next read
+			if seq == self.idx[1] or seq & 1:
+				return None
+			fields = self.record.unpack_from(self.data, 0)
+			if self.idx[0] == seq:
+				break
+		self.idx[1] = seq #acknowledge
+		return Sample(*fields)
+
+	def get_nowait(self):
+		sample = self.latest()
+		if sample is None:
+			raise Empty
+		return sample
+
+	def close(self):
+		"""
+		Release the shared memory, call from the creating process on exit
+		"""
+		self.idx.release()
+		self.data.release()
+		self.shm.close()
+		self.shm.unlink()
+
+#------------------------------------------------------------------------------
+# Plant streams
+
+def sample_ring(capacity, overwrite=False):
+	"""
+	Ring carrying plant output Samples
+	:param overwrite drop the oldest samples when full
+	"""
+	return ShmRing(Sample.STRUCT, capacity, Sample.fields,
+				   lambda rec: Sample(*rec), overwrite)
+
+def sample_slot():
+	"""
+	Conflating slot carrying the newest plant output Sample
+	"""
+	return SampleSlot()
+
+def command_ring(capacity):
+	"""
+	Ring carrying (Plant.Command, arg) tuples
+	"""
+	return CommandRing(capacity)
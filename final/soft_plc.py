@@ -7,25 +7,43 @@
 # Library Imports
 
 from pymodbus.version import version
-from pymodbus.server.asynchronous import StartTcpServer
+from pymodbus.server.asynchronous import ModbusServerFactory, \
+	ModbusTcpProtocol
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSparseDataBlock, ModbusSequentialDataBlock
+from pymodbus.datastore.store import BaseModbusDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
-from pymodbus.transaction import ModbusRtuFramer, ModbusAsciiFramer
+from pymodbus.transaction import ModbusRtuFramer, ModbusAsciiFramer, \
+	ModbusSocketFramer
 
-from multiprocessing import Queue, Process
+import queue
 import argparse as ap
-from plant import Plant, DEC_OFS
-from enum import Enum, unique, auto
+from collections import Counter
+from plant import Plant, PUT_TIMEOUT, REG_INPUT_MIRROR
+from tags import TagDB, load_tags, TAGS_FILE
+from register_image import RegisterImage
+from datablock import RegisterBlock, BitBlock
+from deadband import ExceptionReport, parse_deadband, HEARTBEAT
+from plant_pool import PlantPool, plant_spec, load_plant_specs, parse_plant_arg
+from tank_sim import SimulatedTankClient
+from scheduler import FixedRateScheduler
+from log_queue import start_logging, parse_sampling, RATE, BURST
+from metrics import Metrics, listen_metrics
 
 from time import sleep, time
 import sys
 import re
 import os
+import json
+import atexit
+import math
 import logging
 from ast import literal_eval as make_tuple #parse tuple
 
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -46,44 +64,159 @@ def verify_is_ip(arg):
 #------------------------------------------------------------------------------
 # Modbus data block
 
-class CallbackDataBlock(ModbusSequentialDataBlock):
+class CallbackDataBlock(BaseModbusDataBlock):
 	"""
-	A datablock that stores the new value in memory
-	and passes the operation to a message queue for further
-	processing.
+	A datablock that stores the new value in memory and notifies the
+	subscribers of the written range. Writes from modbus clients come through
+	setValues, the SoftPLC writes with write(). Subscriptions and
+	notifications use the protocol addresses (the context adds 1 to them).
 	"""
-	def __init__(self, addr, values, queue, fx):
+	CLIENT = 'client'
+	INTERNAL = 'internal'
+
+	def __init__(self, block, fx, image=None):
 		"""
 		Initialize data block
+		:param block data block holding the values (RegisterBlock, BitBlock)
+		:param fx area name (hr, co, di, ir)
+		:param image RegisterImage served on reads of its registers
 		"""
-		self.queue = queue
+		self.block = block
+		self.address = block.address
+		self.default_value = block.default_value
 		self.fx = fx
+		self.image = image
+		#(callback, ranges, sources)
+		self.subscribers = []
 		self.log = logging.getLogger()
-		super(CallbackDataBlock, self).__init__(addr, values)
+
+	@property
+	def values(self):
+		return self.block.values
+
+	def reset(self):
+		self.block.reset()
+
+	def validate(self, address, count=1):
+		return self.block.validate(address, count)
+
+	def subscribe(self, callback, ranges=None, sources=(CLIENT,)):
+		"""
+		Call back on writes overlapping some address ranges
+		:param callback callable(fx, address, values, source), called once per
+		write with all its values
+		:param ranges list of (start, end) addresses, end excluded, None for
+		the whole block
+		:param sources write sources notified, CLIENT and/or INTERNAL
+		"""
+		self.subscribers.append((callback, ranges, sources))
+
+	def notify(self, address, values, source):
+		end = address + len(values)
+		for callback, ranges, sources in self.subscribers:
+			if source in sources and (ranges is None or any(
+					start < end and address < stop for start, stop in ranges)):
+				callback(self.fx, address, values, source)
 
 	def setValues(self, address, values):
 		"""
-		Sets the requested values of the datastore
+		Sets the requested values of the datastore, modbus client writes
 		:param address: The starting address
-		:param values: The new values to be set, if the first value of address
-		is a string, it signals that it's a self generated command and should
-		not be sent to the queue #GAMBIARRA
-		:param ignore: if the set command is self generated
-		"""
-		# if first value on values is str, don't put it on the queue
-		# (self generated)
-		if type(values[0]) == str:
-			self.log.debug("skipped queue")
-			values = values[1:]
+		:param values: The new values to be set
+		"""
+		self.log.debug("address: %i values: %s", address, values)
+		self.block.setValues(address, values)
+		self.notify(address - 1, values, self.CLIENT)
+
+	def write(self, address, values, source=INTERNAL):
+		"""
+		Set values from inside the server
+		:param address protocol address of values[0]
+		"""
+		self.block.setValues(address + 1, values)
+		self.notify(address, values, source)
+
+	def getValues(self, address, count=1):
+		"""
+		Returns the requested values of the datastore, the registers held by
+		the register image come from its last published snapshot
+		"""
+		values = self.block.getValues(address, count)
+		if self.image is not None:
+			values = self.image.overlay(self.fx, address - 1, list(values))
+		return values
+
+class WriteQueue(queue.Queue):
+	"""
+	Queue of the client writes of a plant, subscribed to its data blocks
+	"""
+	def __init__(self, maxsize, on_write=None):
+		"""
+		:param on_write callable() run after a write is queued
+		"""
+		super().__init__(maxsize)
+		self.on_write = on_write
+		self.dropped = 0 #writes lost because the queue was full
+		self.log = logging.getLogger()
+
+	def __call__(self, fx, address, values, source):
+		if not self.full():
+			self.put_nowait((fx, address, values))
+			if self.on_write is not None:
+				self.on_write()
 		else:
-			if not self.queue.full():
-				self.queue.put_nowait((self.fx, address, values))
-			else:
-				self.log.error("callback:  queue is full")
+			self.dropped += 1
+			self.log.error("callback:  queue is full")
 
-		self.log.debug("address: {} values: {}".format(address, values))
-		#call parent class method
-		super(CallbackDataBlock, self).setValues(address, values)
+#------------------------------------------------------------------------------
+# Modbus server
+
+class CountingProtocol(ModbusTcpProtocol):
+	"""
+	Modbus TCP connection counting the requests it executes
+	"""
+	def _execute(self, request):
+		self.factory.requests[(request.unit_id, request.function_code)] += 1
+		super()._execute(request)
+
+class CountingServerFactory(ModbusServerFactory):
+	"""
+	Modbus TCP server keeping the request count of each unit and function
+	code in requests
+	"""
+	protocol = CountingProtocol
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.requests = Counter()
+
+#------------------------------------------------------------------------------
+# Reactor events
+
+@implementer(IReadDescriptor)
+class DoorbellReader():
+	"""
+	Reactor read descriptor running a callback when a plant Doorbell rings,
+	until the callback returns False. The plant rings after the sample is in
+	shared memory (ring or slot), so it is there when the reactor reads.
+	"""
+	def __init__(self, bell, callback):
+		self.bell = bell
+		self.callback = callback
+
+	def fileno(self):
+		return self.bell.fileno()
+
+	def doRead(self):
+		self.bell.drain()
+		while self.callback():
+			pass
+
+	def logPrefix(self):
+		return 'doorbell'
+
+	def connectionLost(self, reason):
+		pass
 
 #------------------------------------------------------------------------------
 # Data processing loop
@@ -92,111 +225,186 @@ class SoftPLC():
 	"""
 	Class that integrates a modbus server and PID controller input and outputs
 	"""
-	def __init__(self, plant_q, modbus_server_q, modbus_server_context, log):
+	#work counters: queue items read, values superseded by a newer one
+	#(writes to the same address, older samples) and items lost to a full
+	#queue
+	COUNTERS = ('drained', 'coalesced', 'dropped')
+
+	def __init__(self, plant_q, modbus_server_q, blocks, log, tags, unit=0,
+				 drain=False):
 		"""
 		Initialize variables
+		:param modbus_server_q WriteQueue of the plant registers
+		:param blocks dict of area -> CallbackDataBlock of the plant registers
+		:param tags TagDB of the registers
+		:param unit modbus unit id holding this plant's registers
+		:param drain process every pending write and only the newest sample on
+		each tick instead of one of each
 		"""
 		self.plant_out_q = plant_q['out']
 		self.plant_in_q  = plant_q['in']
 		self.modbus_q = modbus_server_q
-		self.modbus_c = modbus_server_context
+		self.blocks = blocks
 		self.log = log
+		self.tags = tags
+		self.unit = unit
+		self.drain = drain
+		#counters of the current tick, of the last tick that did some work and
+		#since the start
+		self.pending = dict.fromkeys(self.COUNTERS, 0)
+		self.tick = dict.fromkeys(self.COUNTERS, 0)
+		self.total = dict.fromkeys(self.COUNTERS, 0)
+		self.queue_drops = 0
+		#commands lost to a full plant in queue, the dropped counters also
+		#count the write queue drops
+		self.in_q_dropped = 0
+		#last values written to each output block
+		self.written = {}
+
+	def count(self, **counts):
+		"""
+		Add to the current tick counters
+		"""
+		for k, v in counts.items():
+			self.pending[k] += v
 
-	class hr(Enum):
+	def end_tick(self):
 		"""
-		Holding registers
+		Publish the current tick counters
 		"""
-		# Out 0:49
-		LEVEL = 0
-		OUTFLOW =  1
-		ERROR = 2
-		DEC_OFS = 3
-		# Bidir 50:99
-		OUT_VALVE = 50
-		K_P = 51
-		K_I = 52
-		K_D = 53
-		# In 100:-
-		IN_VALVE = 100
-		SETPOINT = 101
+		if any(self.pending.values()):
+			for k, v in self.pending.items():
+				self.total[k] += v
+			self.tick = self.pending
+			self.pending = dict.fromkeys(self.COUNTERS, 0)
 
-	class co(Enum):
+	def read_sample(self):
 		"""
-		Binary inputs
+		Read the next plant sample, the newest one if the transport allows it
+		or in drain mode
+		:return the sample or None
 		"""
-		START_BTN = 0
-		STOP_BTN = 1
-		EMERG_BTN = 2
-		AUTO_MODE = 3
+		if hasattr(self.plant_out_q, 'latest'):
+			n = self.plant_out_q.qsize()
+			self.count(drained=n, coalesced=max(0, n - 1))
+			return self.plant_out_q.latest()
+		res = None
+		while not self.plant_out_q.empty():
+			if res is not None:
+				self.count(coalesced=1)
+			res = self.plant_out_q.get_nowait()
+			self.count(drained=1)
+			if not self.drain:
+				break
+		return res
 
 	def __call__(self):
 		"""
 		Main method called in a loop
 		"""
+		self.process_write()
+		self.process_sample()
+		self.end_tick()
+
+	def write_tick(self):
+		"""
+		Event driven tick of a modbus write
+		"""
+		self.process_write()
+		self.end_tick()
+
+	def sample_tick(self):
+		"""
+		Event driven tick of a plant sample
+		:return True if there was a sample
+		"""
+		res = self.process_sample()
+		self.end_tick()
+		return res
+
+	def commands(self, fx, address, values):
+		"""
+		Plant commands of a modbus write, one per register or coil
+		:return list of (Plant.Command, arg)
+		"""
+		self.log.debug('fx: %s address: %i values: %s', fx, address, values)
 
-		# mapping of addresses and commands
-		plant_co_map = {
-			self.co.START_BTN.value: plant.Command.START,
-			self.co.STOP_BTN.value:  plant.Command.STOP,
-			self.co.EMERG_BTN.value: plant.Command.EMERGENCY,
-			self.co.AUTO_MODE.value: plant.Command.AUTO_MODE,
-		}
-		# mapping of holding registers
-		plant_hr_map = {
-			self.hr.IN_VALVE.value:  plant.Command.IN_VALVE,
-			self.hr.OUT_VALVE.value: plant.Command.OUT_VALVE,
-			self.hr.SETPOINT.value:  plant.Command.SETPOINT,
-			self.hr.K_P.value:       plant.Command.SET_K_P,
-			self.hr.K_I.value:       plant.Command.SET_K_I,
-			self.hr.K_D.value:       plant.Command.SET_K_D,
-		}
-
-		# Process write requests
-		# read modbus requests
-		if not self.modbus_q.empty():
-			fx, address, value = self.modbus_q.get_nowait()
-
-			if type(value) == list and len(value) > 1:
-				self.log.error("multi register write!\n\n\n")
-
-			cmd = () #initialize variable
-			address -= 1 #remove addresss offset
-			self.log.debug('fx: %s address: %i value: %i' % (fx, address, value[0]))
-
-			# process request by function code
-			if fx == 'hr':
-				if address in plant_hr_map.keys():
-					cmd = (plant_hr_map[address], value[0])
-				else:
-					self.log.warning('unkwnown hr address %i' % address)
-			if fx == 'co':
-				if address in plant_co_map.keys():
-					cmd = (plant_co_map[address], value[0])
-				else:
-					self.log.warning('unkwnown co address %i' % address)
+		cmds = []
+		for addr, value in enumerate(values, address):
+			cmd = self.tags.command(fx, addr)
+			if cmd is not None:
+				cmds.append((cmd, value))
 			else:
-				self.log.warning("write on read only address")
+				self.log.warning('write on read only or unknown %s address %i',
+								 fx, addr)
+		return cmds
 
-			#send command to plant
-			if cmd and (not self.plant_in_q.full()):
+	def send(self, cmds):
+		"""
+		Send commands to the plant, several commands go as one batch applied
+		in the same plant cycle
+		"""
+		if not cmds:
+			return
+		cmd = cmds[0] if len(cmds) == 1 else \
+			(Plant.Command.BATCH, tuple(cmds))
+		if not self.plant_in_q.full():
+			try:
 				self.plant_in_q.put_nowait(cmd)
+				return
+			except queue.Full:
+				pass #no room for the whole batch
+		self.count(dropped=1)
+		self.in_q_dropped += 1
+		self.log.error('soft plc: plant %i in queue is full', self.unit)
+
+	def write_drops(self):
+		"""
+		Writes dropped by the write queue since the last call
+		"""
+		n = self.modbus_q.dropped
+		new, self.queue_drops = n - self.queue_drops, n
+		return new
 
-		#read plant output values
-		if not self.plant_out_q.empty():
-			res = self.plant_out_q.get_nowait()
-			if res:
-				#update modbus registers from plant result
-				v = self.modbus_c[0]
-				v.setValues(3, self.hr.LEVEL.value,
-							['s', int(DEC_OFS*res[plant.Output.LEVEL])])
-				v.setValues(3, self.hr.OUTFLOW.value,
-							['s', int(DEC_OFS*res[plant.Output.OUTFLOW])])
-				v.setValues(3, self.hr.IN_VALVE.value,
-							['s', int(DEC_OFS*res[plant.Output.IN_VALVE])])
-				v.setValues(3, self.hr.OUT_VALVE.value,
-							['s', int(DEC_OFS*res[plant.Output.OUT_VALVE])])
-				v.setValues(3, self.hr.SETPOINT.value,
-							['s', int(DEC_OFS*res[plant.Output.SETPOINT])])
+	def process_write(self):
+		"""
+		Send the next modbus write to the plant, or all of them in drain mode
+		as one batch with only the last write to each address
+		"""
+		self.count(dropped=self.write_drops())
+		if not self.drain:
+			if not self.modbus_q.empty():
+				self.count(drained=1)
+				self.send(self.commands(*self.modbus_q.get_nowait()))
+			return
+
+		writes = {}
+		n = n_values = 0
+		while not self.modbus_q.empty():
+			fx, address, values = self.modbus_q.get_nowait()
+			#last write wins, in the order of the last writes
+			for addr, value in enumerate(values, address):
+				writes.pop((fx, addr), None)
+				writes[(fx, addr)] = value
+			n += 1
+			n_values += len(values)
+		self.count(drained=n, coalesced=n_values - len(writes))
+		self.send([cmd for (fx, addr), value in writes.items()
+				   for cmd in self.commands(fx, addr, [value])])
+
+	def process_sample(self):
+		"""
+		Update the modbus registers from the next plant sample
+		:return True if there was a sample
+		"""
+		res = self.read_sample()
+		if res is not None:
+			#update the modbus registers that changed
+			for area, address, values in self.tags.outputs(res):
+				if self.written.get((area, address)) != values:
+					self.blocks[area].write(address, values)
+					self.written[(area, address)] = values
+		return res is not None
 
 #------------------------------------------------------------------------------
 # Implementation
@@ -216,31 +424,155 @@ parser.add_argument('--plant_port', type=int, metavar="plant port",\
 parser.add_argument('--tunings', type=make_tuple, \
 					help='PID tunings as Kp,Ki,Kd',\
 					metavar="K_p,K_i,K_d", required=0)
+parser.add_argument('--io_mode', choices=[m.value for m in Plant.IOMode],
+					help='plant modbus I/O: one request per operation, '
+					'FC23 read/write or pipelined requests, defaults to single',
+					default=Plant.IOMode.SINGLE.value, required=0)
+parser.add_argument('--input_mirror', type=int, metavar='ADDR',
+					help='holding register where the plant server mirrors its '
+					'4 input registers, required by --io_mode fc23 (pipelined '
+					'is used without it), defaults to {} with --sim'.format(
+					REG_INPUT_MIRROR), required=0)
+parser.add_argument('--engine', choices=['sync', 'async'],
+					help='plant engine: blocking modbus client or asyncio '
+					'event loop, defaults to sync', default='sync', required=0)
+parser.add_argument('--overrun', choices=[m.value for m in
+										  FixedRateScheduler.Overrun],
+					help='what the plant loop does when a cycle overruns its '
+					'period, defaults to skip', default='skip', required=0)
+parser.add_argument('--plants', metavar='plants.json',
+					help='run a pool of plants, JSON list of objects with '
+					'host, port, tunings, unit, setpoint, out_valve and '
+					'in_valve keys, the plant is served on its modbus unit id',
+					required=0)
+parser.add_argument('--plant', action='append', metavar='host[:port]',
+					help='add a plant to the pool, may be repeated, units are '
+					'numbered from 1', default=[], required=0)
+parser.add_argument('--transport', choices=['queue', 'shm'],
+					help='plant to SoftPLC transport: multiprocessing queues '
+					'or lock free shared memory rings, defaults to queue',
+					default='queue', required=0)
+parser.add_argument('--log_format', choices=['csv', 'bin'],
+					help='plant data logfile format: CSV lines or binary '
+					'columns written by a background thread, convert with '
+					'data_log.py, defaults to csv', default='csv', required=0)
+parser.add_argument('--log_max_mb', type=float, metavar='MB',
+					help='rotate the data log in compressed segments of at '
+					'most this size', required=0)
+parser.add_argument('--log_max_age', type=float, metavar='seconds',
+					help='rotate the data log in compressed segments of at '
+					'most this age', required=0)
+parser.add_argument('--backpressure', choices=[m.value for m in
+					Plant.Backpressure], default='drop_newest',
+					help='what a plant does with a sample when its output '
+					'queue is full: drop it (drop_newest, default), drop the '
+					'oldest queued one (drop_oldest), keep only the newest in '
+					'a one sample slot in shared memory whatever the '
+					'--transport (conflate) or wait up to --put_timeout '
+					'(block)', required=0)
+parser.add_argument('--put_timeout', type=float, metavar='seconds',
+					help='max wait of the block backpressure, defaults to '
+					'{}'.format(PUT_TIMEOUT), default=PUT_TIMEOUT, required=0)
+parser.add_argument('--event_driven', action='store_true',
+					help='wake the SoftPLC on modbus writes and plant samples '
+					'instead of polling the queues every 10 ms, needs the shm '
+					'transport, the conflate backpressure or the register '
+					'image', required=0)
+parser.add_argument('--drain', action='store_true',
+					help='process every pending modbus write (the last one '
+					'to each address) and only the newest plant sample on '
+					'each SoftPLC tick', required=0)
+parser.add_argument('--tags', metavar='tags.csv',
+					help='register map of each plant, defaults to '
+					'final/tags.csv', default=TAGS_FILE, required=0)
+parser.add_argument('--register_image', action='store_true',
+					help='plants write their output registers to a double '
+					'buffered shared memory image served directly by the '
+					'modbus server instead of sending samples to the SoftPLC',
+					required=0)
+parser.add_argument('--report_by_exception', action='store_true',
+					help='only publish plant samples when a signal moves past '
+					'its deadband, or after --heartbeat seconds', required=0)
+parser.add_argument('--deadband', action='append', type=parse_deadband,
+					metavar='signal=abs[,pct%]', default=[],
+					help='deadband of a sample field (level, outflow, '
+					'out_valve, in_valve, setpoint), may be repeated, defaults '
+					'to any change', required=0)
+parser.add_argument('--heartbeat', type=float, metavar='seconds',
+					help='publish a sample at least this often with '
+					'--report_by_exception, 0 disables it, defaults to '
+					'{}'.format(HEARTBEAT), default=HEARTBEAT, required=0)
+parser.add_argument('--sim', action='store_true',
+					help='run the plants against the simulated tank instead '
+					'of the modbus plant server (plant_ip is ignored), sync '
+					'engine and single or fc23 io mode only',
+					required=0)
+parser.add_argument('--stats_interval', type=float, metavar='seconds',
+					help='period of the plant loop lateness and SoftPLC '
+					'counters report, '
+					'defaults to 60', default=60, required=0)
+parser.add_argument('--stats_out', metavar='stats.json',
+					help='also write the stats as JSON to this file at every '
+					'report and on shutdown', required=0)
+parser.add_argument('--log_rate', type=float, metavar='messages/s',
+					help='max rate of each log message type, 0 disables the '
+					'limit, defaults to {}'.format(RATE), default=RATE,
+					required=0)
+parser.add_argument('--log_burst', type=int, metavar='messages',
+					help='log messages of a type let through at once, '
+					'defaults to {}'.format(BURST), default=BURST, required=0)
+parser.add_argument('--log_sample', action='append', type=parse_sampling,
+					metavar='LEVEL=N', default=[],
+					help='log one of every N messages of each type of a '
+					'level, e.g. DEBUG=100, repeatable', required=0)
+parser.add_argument('--metrics_port', type=int, metavar='port',
+					help='serve Prometheus metrics over HTTP on this port of '
+					'127.0.0.1 (http://127.0.0.1:port/metrics)', required=0)
 args = parser.parse_args()
 
+#the simulated tank stands in for the blocking client, one request at a time
+#or FC23 on its own input mirror
+if args.sim:
+	if args.io_mode not in (Plant.IOMode.SINGLE.value, Plant.IOMode.FC23.value):
+		parser.error('--sim supports --io_mode single or fc23')
+	if args.engine != 'sync':
+		parser.error('--sim supports the sync engine only')
+	if args.input_mirror not in (None, REG_INPUT_MIRROR):
+		parser.error('the simulated tank mirrors its inputs at {}'.format(
+			REG_INPUT_MIRROR))
+
+#a multiprocessing queue hands the sample to a feeder thread, the doorbell
+#would ring before the reader can see it
+if args.event_driven and args.transport == 'queue' and \
+   args.backpressure != Plant.Backpressure.CONFLATE.value and \
+   not args.register_image:
+	parser.error('--event_driven needs --transport shm, --backpressure '
+				 'conflate or --register_image')
+
 #------------------------------------------------------------------------------
 # logging library
-logging.basicConfig()
+#records are formatted and written by a listener thread, the plant
+#processes inherit the queue handler
+log_listener, log_handler, log_limit = start_logging(
+	LOG_LEVEL, args.log_rate, args.log_burst, dict(args.log_sample))
+#flush the queued records on exit
+atexit.register(log_listener.stop)
 log = logging.getLogger()
-log.setLevel(LOG_LEVEL)
 
 #Check that input IP's makes sense
 args.plant_ip = args.plant_ip[1:-1]
 if not verify_is_ip(args.plant_ip):
-	log.error('provided plant ip', args.ip, ' is invalid')
+	log.error('provided plant ip %s is invalid', args.plant_ip)
 	sys.exit(-1)
 
 args.server_ip = args.server_ip[1:-1]
 if not verify_is_ip(args.server_ip):
-	log.error('provided server ip', args.ip, ' is invalid')
+	log.error('provided server ip %s is invalid', args.server_ip)
 	sys.exit(-1)
 
 #--------------------------------------------------
 # Plant setup
 
-#plant input and output queues
-plant_queues = { 'out':Queue(MAX_Q_LEN), 'in':Queue(MAX_Q_LEN) }
-
 #alternate controllers
 p_tunings = (-41.0959, -0.0, -0.0 )
 pid_tunings = (-5, -1.517, -13.593 )
@@ -250,39 +582,118 @@ tunings = pi_tunings
 
 #Test if tunings were passed from the command line
 if not args.tunings:
-	log.info("using default tunings:", tunings)
+	log.info("using default tunings: %s", tunings)
 else:
-	log.info("tunings:\n\tK_p: %.3f\n\tK_d: %.3f\n\tK_i: %.3f"
-			 % (tunings[0], tunings[1], tunings[2]))
 	tunings = args.tunings
+	log.info("tunings:\n\tK_p: %.3f\n\tK_i: %.3f\n\tK_d: %.3f",
+			 tunings[0], tunings[1], tunings[2])
+
+#plants to run, a single plant is served on every unit id
+if args.plants:
+	plant_specs = load_plant_specs(args.plants, args.plant_ip,
+								   args.plant_port, tunings)
+elif args.plant:
+	plant_specs = [plant_spec(*parse_plant_arg(a, args.plant_port), tunings,
+							  unit=i+1) for i, a in enumerate(args.plant)]
+else:
+	plant_specs = [plant_spec(args.plant_ip, args.plant_port, tunings)]
+single_plant = not (args.plants or args.plant)
 
-# Create plant instance
-plant = Plant(tunings , (args.plant_ip, args.plant_port), plant_queues,
-			  log_level=LOG_LEVEL)
-plant_proc = Process(target=plant.run, name="plant", args=(0, 0, 0))
+tags = TagDB(load_tags(args.tags))
+
+def make_plant(spec, queues):
+	"""
+	Create a plant instance for a pool worker
+	"""
+	if args.register_image:
+		#released with the queues when the pool stops
+		queues['image'] = RegisterImage(tags)
+	if args.engine == 'async':
+		from async_plant import AsyncPlant
+		plant_engine = AsyncPlant
+	else:
+		plant_engine = Plant
+	return plant_engine(spec['tunings'], (spec['host'], spec['port']), queues,
+						log_level=LOG_LEVEL, io_mode=args.io_mode,
+						overrun=args.overrun, log_format=args.log_format,
+						log_max_bytes=int(args.log_max_mb*2**20)
+						if args.log_max_mb else None,
+						log_max_age=args.log_max_age,
+						client=SimulatedTankClient(setpoint=spec['setpoint'])
+						if args.sim else None,
+						report=ExceptionReport(dict(args.deadband),
+											   args.heartbeat, shared=True)
+						if args.report_by_exception else None,
+						backpressure=args.backpressure,
+						put_timeout=args.put_timeout,
+						input_mirror=REG_INPUT_MIRROR if args.sim
+						else args.input_mirror)
+
+# Create plant instances
+plant_pool = PlantPool(plant_specs, make_plant, MAX_Q_LEN, log,
+					   transport=args.transport, doorbell=args.event_driven,
+					   backpressure=args.backpressure)
 
 #--------------------------------------------------
 # Modbus server setup
 
-modbus_q = Queue(MAX_Q_LEN)
 initval = 21
 
-modbus_store = ModbusSlaveContext(
-	di=CallbackDataBlock(0, [initval]*1000, modbus_q, "di"),
-	co=CallbackDataBlock(0, [initval]*1000, modbus_q, "co"),
-	hr=CallbackDataBlock(0, [initval]*1000, modbus_q, "hr"),
-	ir=CallbackDataBlock(0, [initval]*1000, modbus_q, "ir")
-)
-
-modbus_context = ModbusServerContext(slaves=modbus_store, single=True)
-
-#Set initial values for registers
-modbus_store.setValues(3, SoftPLC.hr.K_P.value, [int(-1*DEC_OFS*tunings[0])])
-modbus_store.setValues(3, SoftPLC.hr.K_I.value, [int(-1*DEC_OFS*tunings[1])])
-modbus_store.setValues(3, SoftPLC.hr.K_D.value, [int(-1*DEC_OFS*tunings[2])])
-modbus_store.setValues(3, SoftPLC.hr.DEC_OFS.value, [DEC_OFS])
-modbus_store.setValues(3, SoftPLC.hr.IN_VALVE.value, [5*DEC_OFS])
-modbus_store.setValues(1, SoftPLC.co.AUTO_MODE.value, [True])
+def make_store(modbus_q, tunings, tags, image=None):
+	"""
+	Create the registers of one plant
+	:param modbus_q WriteQueue receiving the client writes to command tags
+	:param tags TagDB of the registers
+	:param image RegisterImage of the plant output registers
+	:return ModbusSlaveContext, dict of area -> CallbackDataBlock
+	"""
+	#at least 1000 registers per area, more if the tags need them
+	blocks = {}
+	for area in ('di', 'co', 'hr', 'ir'):
+		size = max(1000, tags.size[area] + 1)
+		blocks[area] = CallbackDataBlock(
+			(BitBlock if area in ('co', 'di') else RegisterBlock)(
+				0, size, initval), area, image)
+		ranges = tags.command_ranges(area)
+		if ranges:
+			blocks[area].subscribe(modbus_q, ranges)
+	modbus_store = ModbusSlaveContext(**blocks)
+
+	#Set initial values for registers, the tunings are stored positive, they
+	#are sent to the plant like client writes
+	overrides = { 'K_P': -tunings[0], 'K_I': -tunings[1], 'K_D': -tunings[2] }
+	for area, address, values in tags.initial_values(overrides):
+		blocks[area].write(address, values, CallbackDataBlock.CLIENT)
+	return modbus_store, blocks
+
+#SoftPLC of each unit, created below
+soft_plc_units = {}
+
+def write_event(unit):
+	"""
+	Callback of the modbus writes of a unit in event driven mode, processes
+	the write on the next reactor iteration
+	"""
+	#looked up when called, the initial register values are written before
+	#the SoftPLCs exist
+	return lambda: reactor.callLater(
+		0, lambda: soft_plc_units[unit].write_tick())
+
+modbus_qs = {}
+modbus_stores = {}
+modbus_blocks = {}
+for w in plant_pool.workers:
+	unit = w['spec']['unit']
+	#filled and consumed by the reactor thread
+	modbus_qs[unit] = WriteQueue(MAX_Q_LEN,
+		write_event(unit) if args.event_driven else None)
+	modbus_stores[unit], modbus_blocks[unit] = make_store(
+		modbus_qs[unit], w['spec']['tunings'], tags, w['queues'].get('image'))
+
+if single_plant:
+	modbus_context = ModbusServerContext(slaves=modbus_stores[0], single=True)
+else:
+	modbus_context = ModbusServerContext(slaves=modbus_stores, single=False)
 
 modbus_identity = ModbusDeviceIdentification()
 modbus_identity.VendorName = 'pymodbus'
@@ -291,17 +702,160 @@ modbus_identity.VendorUrl = 'http://github.com/riptideio/pymodbus/'
 modbus_identity.ProductName = 'Parvus Scala'
 modbus_identity.ModelName = 'Parvus Scala 1.0'
 modbus_identity.MajorMinorRevision = version.short()
+modbus_server = CountingServerFactory(modbus_context, ModbusSocketFramer,
+									  modbus_identity)
 
 #------------------------------------------------------------------------------
 # Soft PLC Instance
 
 soft_plc_loopdelay = 0.010 #10 ms
-soft_plc = SoftPLC(plant_queues, modbus_q, modbus_context, log)
-soft_plc_loop = LoopingCall(f=soft_plc)
+supervise_delay = 1.0
+soft_plcs = [SoftPLC(w['queues'], modbus_qs[w['spec']['unit']],
+					 modbus_blocks[w['spec']['unit']], log, tags,
+					 unit=w['spec']['unit'],
+					 drain=args.drain)
+			 for w in plant_pool.workers]
+soft_plc_units.update((s.unit, s) for s in soft_plcs)
+
+def run_soft_plcs():
+	"""
+	Process the queues of every plant
+	"""
+	for soft_plc in soft_plcs:
+		soft_plc()
+soft_plc_loop = LoopingCall(f=run_soft_plcs)
+supervise_loop = LoopingCall(f=plant_pool.supervise)
 
-# start processes
-soft_plc_loop.start(soft_plc_loopdelay)
-plant_proc.start()
+def report_stats():
+	"""
+	Log the plant loop lateness histograms, the phase timing of the last
+	window of cycles and the SoftPLC work counters
+	"""
+	for w, soft_plc in zip(plant_pool.workers, soft_plcs):
+		log.info('plant %i loop lateness [s]: %s', w['spec']['unit'],
+				 w['plant'].lateness.summary())
+		log.info('plant %i loop phases mean/max [ms]: %s', w['spec']['unit'],
+				 w['plant'].timing.summary(window=True))
+		log.info('plant %i soft plc last tick: %s total: %s',
+				 w['spec']['unit'], soft_plc.tick, soft_plc.total)
+		if w['plant'].report is not None:
+			log.info('plant %i report by exception: %s', w['spec']['unit'],
+					 w['plant'].report.summary())
+	log.info('logging: %s dropped %i', log_limit.summary(),
+			 log_handler.dropped.value)
+	if args.stats_out:
+		write_stats(args.stats_out)
+stats_loop = LoopingCall(f=report_stats)
+
+def stats():
+	"""
+	Stats of every plant as a JSON serializable dict
+	"""
+	res = {'time': time(), 'plants': []}
+	for w, soft_plc in zip(plant_pool.workers, soft_plcs):
+		report = w['plant'].report
+		res['plants'].append({
+			'unit': w['spec']['unit'],
+			'started': w['plant'].started.value,
+			'lateness': w['plant'].lateness.snapshot(),
+			'timing': w['plant'].timing.snapshot(),
+			'soft_plc': {'tick': soft_plc.tick, 'total': soft_plc.total},
+			'write_queue_dropped': modbus_qs[w['spec']['unit']].dropped,
+			'in_queue_dropped': soft_plc.in_q_dropped,
+			'out_discarded': w['plant'].discarded(),
+			'report': None if report is None else
+				{'reported': report.reported, 'suppressed': report.suppressed},
+		})
+	return res
+
+def collect_metrics():
+	"""
+	Metrics of a scrape, read from the SoftPLC counters and the shared
+	counters of the plants
+	"""
+	m = Metrics()
+	now = time()
+	for w, soft_plc in zip(plant_pool.workers, soft_plcs):
+		unit = w['spec']['unit']
+		plant = w['plant']
+		labels = {'unit': unit}
+		for name, q, dropped in (
+				('modbus_q', modbus_qs[unit], modbus_qs[unit].dropped),
+				('plant_in_q', w['queues']['in'], soft_plc.in_q_dropped),
+				('plant_out_q', w['queues']['out'], plant.discarded())):
+			q_labels = dict(labels, queue=name)
+			m.gauge('softplc_queue_depth', 'Items waiting in a queue',
+					q.qsize(), q_labels)
+			m.counter('softplc_queue_dropped_total',
+					  'Items lost because a queue was full', dropped, q_labels)
+		for k in ('drained', 'coalesced'):
+			m.counter('softplc_items_total', 'Queue items read by the SoftPLC '
+					  '(drained) and superseded by a newer one (coalesced)',
+					  soft_plc.total[k], dict(labels, counter=k))
+		m.counter('plant_samples_published_total',
+				  'Samples published by the plant', plant.out_counts[0], labels)
+		last = plant.last_publish.value
+		m.gauge('plant_sample_age_seconds',
+				'Time since the plant published its last sample',
+				now - last if last else math.nan, labels)
+		m.histogram('plant_loop_period_seconds',
+					'Measured period of the plant loop cycles',
+					plant.periods, labels)
+		m.histogram('plant_loop_lateness_seconds',
+					'Delay of the plant loop cycles after their deadline',
+					plant.lateness, labels)
+		m.counter('plant_loop_overruns_total',
+				  'Plant loop cycles that ended after the next deadline',
+				  plant.timing.overruns, labels)
+		for phase, h in zip(plant.timing.phases, plant.timing.total):
+			m.histogram('plant_loop_phase_seconds',
+						'Time spent in each phase of the plant loop cycles',
+						h, dict(labels, phase=phase), scale=1e-9)
+	for (unit, fc), n in sorted(modbus_server.requests.items()):
+		m.counter('modbus_requests_total',
+				  'Modbus requests executed per unit and function code', n,
+				  {'unit': unit, 'function_code': fc})
+	return m
+
+def write_stats(path):
+	"""
+	Replace the stats file, readers never see a partial file
+	"""
+	with open(path + '.tmp', 'w') as f:
+		json.dump(stats(), f, indent=1)
+	os.replace(path + '.tmp', path)
+
+#plant sample events, the modbus writes are hooked to the data blocks
+doorbell_readers = [DoorbellReader(w['queues']['bell'], s.sample_tick)
+					for w, s in zip(plant_pool.workers, soft_plcs)] \
+	if args.event_driven else []
 
-StartTcpServer(modbus_context, identity=modbus_identity,
-			   address=(args.server_ip, args.server_port))
+def shutdown():
+	"""
+	Stop the plants after detaching their doorbells from the reactor
+	"""
+	for r in doorbell_readers:
+		reactor.removeReader(r)
+	if args.stats_out:
+		write_stats(args.stats_out)
+	plant_pool.stop()
+
+# start processes
+if args.event_driven:
+	for r in doorbell_readers:
+		reactor.addReader(r)
+else:
+	soft_plc_loop.start(soft_plc_loopdelay)
+stats_loop.start(args.stats_interval, now=False)
+plant_pool.start()
+supervise_loop.start(supervise_delay, now=False)
+reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+
+if args.metrics_port:
+	listen_metrics(args.metrics_port, collect_metrics)
+	log.info('metrics on http://127.0.0.1:%i/metrics', args.metrics_port)
+
+log.info('starting modbus TCP server on %s:%i', args.server_ip,
+		 args.server_port)
+reactor.listenTCP(args.server_port, modbus_server, interface=args.server_ip)
+reactor.run()
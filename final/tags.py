@@ -0,0 +1,164 @@
+#!/bin/python
+"""
+SoftPLC tag database: the register map read from a tag file and compiled
+into address indexed dispatch tables and output register blocks
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import csv
+from collections import namedtuple
+
+from plant import Plant, DEC_OFS
+from sample import FIELDS
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#default tag file
+TAGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+						 'tags.csv')
+
+#coils, discrete inputs, holding registers, input registers
+AREAS = ('co', 'di', 'hr', 'ir')
+DIRECTIONS = ('in', 'out', 'inout')
+
+Tag = namedtuple('Tag', ('name', 'area', 'address', 'scale', 'direction',
+						 'command', 'output', 'init'))
+
+#-----------------------------------------------------------
+# Tag file
+
+def parse_tag(row):
+	"""
+	Tag of a tag file row
+	"""
+	area = row['area'].strip()
+	direction = row['direction'].strip()
+	if area not in AREAS:
+		raise ValueError('unknown area {}'.format(area))
+	if direction not in DIRECTIONS:
+		raise ValueError('unknown direction {}'.format(direction))
+	scale = row['scale'].strip()
+	command = row['command'].strip()
+	output = row['output'].strip()
+	if output and output not in FIELDS:
+		raise ValueError('unknown sample field {}'.format(output))
+	init = row['init'].strip()
+	return Tag(row['name'].strip(), area, int(row['address']),
+			   DEC_OFS if scale == 'DEC_OFS' else float(scale), direction,
+			   Plant.Command[command] if command else None, output or None,
+			   float(init) if init else None)
+
+def load_tags(path=TAGS_FILE):
+	"""
+	Read a tag file, CSV with a header line, '#' starts a comment line
+	:return list of Tag
+	"""
+	with open(path) as f:
+		lines = [l for l in f if l.strip() and not l.startswith('#')]
+	tags = []
+	for n, row in enumerate(csv.DictReader(lines), 2):
+		try:
+			tags.append(parse_tag(row))
+		except (ValueError, KeyError, TypeError) as e:
+			raise ValueError('{}: tag {}: {}'.format(path, n, e))
+	return tags
+
+#------------------------------------------------------------------------------
+# Compiled tags
+
+class TagDB():
+	"""
+	Register map compiled for the SoftPLC hot path:
+	commands[area][address] is the Plant.Command written by that register
+	(None if read only) and blocks holds the runs of contiguous output
+	registers updated from each Sample with one write
+	"""
+	def __init__(self, tags):
+		"""
+		:param tags list of Tag
+		"""
+		self.tags = { t.name: t for t in tags }
+		if len(self.tags) != len(tags):
+			raise ValueError('duplicated tag name')
+		seen = set()
+		for t in tags:
+			if (t.area, t.address) in seen:
+				raise ValueError('{}: duplicated address {} {}'.format(
+					t.name, t.area, t.address))
+			seen.add((t.area, t.address))
+
+		#register count of each area
+		self.size = { a: 1 + max([t.address for t in tags if t.area == a],
+								 default=-1) for a in AREAS }
+
+		self.commands = { a: [None]*self.size[a] for a in AREAS }
+		for t in tags:
+			if t.direction != 'out' and t.command is not None:
+				self.commands[t.area][t.address] = t.command
+
+		#(area, start address, ((field, scale), ...))
+		self.blocks = []
+		outputs = sorted((t.area, t.address, t.output, t.scale) for t in tags
+						 if t.direction != 'in' and t.output is not None)
+		for area, address, output, scale in outputs:
+			if self.blocks and self.blocks[-1][0] == area and \
+			   self.blocks[-1][1] + len(self.blocks[-1][2]) == address:
+				self.blocks[-1][2].append((output, scale))
+			else:
+				self.blocks.append((area, address, [(output, scale)]))
+		self.blocks = [(area, start, tuple(fields))
+					   for area, start, fields in self.blocks]
+
+	def __getitem__(self, name):
+		return self.tags[name]
+
+	def command(self, area, address):
+		"""
+		Plant command written by a register, None if there is none
+		"""
+		cmds = self.commands.get(area)
+		if cmds is None or not 0 <= address < len(cmds):
+			return None
+		return cmds[address]
+
+	def command_ranges(self, area):
+		"""
+		Runs of contiguous registers with a command
+		:return list of (start, end) addresses, end excluded
+		"""
+		ranges = []
+		for address, cmd in enumerate(self.commands[area]):
+			if cmd is None:
+				continue
+			if ranges and ranges[-1][1] == address:
+				ranges[-1][1] += 1
+			else:
+				ranges.append([address, address + 1])
+		return [tuple(r) for r in ranges]
+
+	def outputs(self, sample):
+		"""
+		Register values of a Sample
+		:return list of (area, start address, values)
+		"""
+		return [(area, start, [int(scale*getattr(sample, field))
+							   for field, scale in fields])
+				for area, start, fields in self.blocks]
+
+	def initial_values(self, overrides=None):
+		"""
+		Initial register values
+		:param overrides dict of tag name -> value replacing the tag file init
+		:return list of (area, address, [value])
+		"""
+		overrides = overrides or {}
+		res = []
+		for t in self.tags.values():
+			v = overrides.get(t.name, t.init)
+			if v is not None:
+				res.append((t.area, t.address, [int(t.scale*v)]))
+		return res
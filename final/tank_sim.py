@@ -0,0 +1,192 @@
+#!/bin/python
+"""
+Simulated tank that replaces the Factory IO modbus server, so the closed
+loop can run in process and faster than real time
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import time
+import logging
+import argparse as ap
+from queue import Queue
+from ast import literal_eval as make_tuple #parse tuple
+
+from plant import Plant, V_OFS, REG_IN_VALVE, REG_OUT_VALVE, \
+	REG_INPUT_MIRROR, CTL_STOP_START, CTL_PAUSE
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#tank model, level h as a fraction of the tank height:
+# dh/dt = Q_IN*u_in - Q_OUT*u_out*sqrt(h)
+Q_IN = 0.07 #level rate with the input valve fully open [1/s]
+Q_OUT = 0.10 #level rate with the output valve fully open and a full tank [1/s]
+#integration step [s]
+SIM_DT = 0.05
+
+#-----------------------------------------------------------
+# Model
+
+def clamp(v, lo=0.0, hi=1.0):
+	return min(max(v, lo), hi)
+
+def outflow(h, u_out):
+	"""
+	Output flow as a fraction of the maximum, works on floats or arrays
+	"""
+	return u_out*h**0.5
+
+def level_rate(h, u_in, u_out):
+	"""
+	Level derivative, works on floats or arrays (h >= 0)
+	"""
+	return Q_IN*u_in - Q_OUT*outflow(h, u_out)
+
+#------------------------------------------------------------------------------
+# Clock
+
+class SimClock():
+	"""
+	Virtual clock with the time module interface, sleep() advances the time
+	instead of waiting
+	"""
+	def __init__(self, start=0.0):
+		self.t = start
+
+	def time(self):
+		return self.t
+
+	def monotonic(self):
+		return self.t
+
+	def sleep(self, dt):
+		self.t += dt
+
+#------------------------------------------------------------------------------
+# Modbus client stand-in
+
+class Response():
+	"""
+	Successful modbus response
+	"""
+	def __init__(self, function_code, registers=None):
+		self.function_code = function_code
+		self.registers = registers
+
+	def isError(self):
+		return False
+
+class SimulatedTankClient():
+	"""
+	Subset of ModbusTcpClient used by Plant, backed by the tank model with the
+	Factory IO register layout: input registers level, outflow, setpoint and
+	T_scale (mirrored at REG_INPUT_MIRROR for FC23), holding registers
+	REG_IN_VALVE, REG_OUT_VALVE and the start/stop and pause coils.
+	The model only advances while started and not paused.
+	"""
+	def __init__(self, clock=time, level=0.0, setpoint=0.0, T_scale=1):
+		"""
+		:param clock time source, the time module or a SimClock
+		:param level initial level (0.0-1.0)
+		:param setpoint value of the setpoint input register (0.0-1.0)
+		:param T_scale value of the time scale input register
+		"""
+		self.clock = clock
+		self.h = level
+		self.setpoint = setpoint
+		self.T_scale = T_scale
+		self.hr = [0, 0]
+		self.coils = [0, 0]
+		self.last_t = clock.monotonic()
+
+	def update(self):
+		"""
+		Integrate the model up to the current time
+		"""
+		now = self.clock.monotonic()
+		dt = (now - self.last_t)*self.T_scale
+		self.last_t = now
+		if not self.coils[CTL_STOP_START] or self.coils[CTL_PAUSE]:
+			return
+		u_in = clamp(self.hr[REG_IN_VALVE]/V_OFS)
+		u_out = clamp(self.hr[REG_OUT_VALVE]/V_OFS)
+		while dt > 0:
+			step = min(dt, SIM_DT)
+			self.h = clamp(self.h + step*level_rate(self.h, u_in, u_out))
+			dt -= step
+
+	def inputs(self):
+		u_out = clamp(self.hr[REG_OUT_VALVE]/V_OFS)
+		return [int(self.h*V_OFS), int(outflow(self.h, u_out)*V_OFS),
+				int(self.setpoint*V_OFS), self.T_scale]
+
+	def connect(self):
+		return True
+
+	def is_socket_open(self):
+		return True
+
+	def close(self):
+		pass
+
+	def read_input_registers(self, address, count=1, unit=0):
+		self.update()
+		return Response(0x04, self.inputs()[address:address+count])
+
+	def write_register(self, address, value, unit=0):
+		self.update()
+		self.hr[address] = value
+		return Response(0x06)
+
+	def write_registers(self, address, values, unit=0):
+		self.update()
+		self.hr[address:address+len(values)] = values
+		return Response(0x10)
+
+	def write_coil(self, address, value, unit=0):
+		self.update()
+		self.coils[address] = int(bool(value))
+		return Response(0x05)
+
+	def readwrite_registers(self, read_address=0, read_count=0,
+							write_address=0, write_registers=(), unit=0):
+		self.write_registers(write_address, list(write_registers))
+		start = read_address - REG_INPUT_MIRROR
+		return Response(0x17, self.inputs()[start:start+read_count])
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	parser = ap.ArgumentParser(description='Run the plant against the '
+							   'simulated tank, faster than real time')
+	parser.add_argument('--tunings', type=make_tuple, metavar='K_p,K_i,K_d',
+						default=(-12.7426, -1.453, -0.0),
+						help='PID tunings, defaults to the PI tunings')
+	parser.add_argument('--duration', type=float, default=3600,
+						help='simulated time [s], defaults to 3600')
+	parser.add_argument('--setpoint', type=float, default=0.5)
+	parser.add_argument('--level', type=float, default=0.0,
+						help='initial level')
+	parser.add_argument('--in_valve', type=float, default=0.5)
+	parser.add_argument('--io_mode', choices=['single', 'fc23'],
+						default='single')
+	parser.add_argument('--log_format', choices=['csv', 'bin'], default='csv')
+	parser.add_argument('--realtime', action='store_true',
+						help='run on the wall clock instead of a virtual one')
+	args = parser.parse_args()
+
+	clock = time if args.realtime else SimClock()
+	client = SimulatedTankClient(clock, level=args.level)
+	#nothing reads the output samples
+	queues = { 'out':Queue(), 'in':Queue() }
+	plant = Plant(args.tunings, ('sim', 0), queues, log_level=logging.INFO,
+				  io_mode=args.io_mode, log_format=args.log_format,
+				  client=client, clock=clock, input_mirror=REG_INPUT_MIRROR)
+	t = time.monotonic()
+	plant.run(args.setpoint, 0, args.in_valve, _end_sim=1,
+			  _duration=args.duration)
+	print('simulated {:.0f} s in {:.2f} s, logfile: {}'.format(
+		args.duration, time.monotonic() - t, plant.sink.path))
@@ -22,6 +22,10 @@ import argparse as ap
 import select
 import re
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+							 '..', 'final'))
+from scheduler import FixedRateScheduler
+
 #-------------------------------------------------------------------------------
 # Constants
 CLP_UNIT = 0x01
@@ -118,7 +122,7 @@ def all_is_same(vec):
 
 def run_sim(client, contr, logf, setpoint, out_valve, in_valve, \
 			_continue_sim=0, _end_sim=0, _no_stop=0, _read_sp=0, \
-			T_scale=1, _T_step=0.01):
+			T_scale=1, _T_step=0.01, _overrun='skip'):
 	"""
 	Run simulation loop until system stabilizes
 	"""
@@ -186,6 +190,7 @@ def run_sim(client, contr, logf, setpoint, out_valve, in_valve, \
 	unpause_sim(client)
 
 	start_time = time.time()
+	sched = FixedRateScheduler(T_step, _overrun)
 	#check if controller enabled, if not run until tank level stabilizes
 	if not contr.auto_mode:
 		while True:
@@ -208,7 +213,7 @@ def run_sim(client, contr, logf, setpoint, out_valve, in_valve, \
 				break
 
 			print(line, last_l)
-			#time.sleep(T_step)
+			sched.wait()
 
 	else:
 		contr.setpoint = setpoint;
@@ -217,7 +222,6 @@ def run_sim(client, contr, logf, setpoint, out_valve, in_valve, \
 		last_t = time.time()
 		c = 0
 		while True:
-			iter_t = time.time() #measure iteration time
 
 			#get modbus registers
 			level, outflow, setpoint, T_scale = read_in_reg(client)
@@ -258,12 +262,12 @@ def run_sim(client, contr, logf, setpoint, out_valve, in_valve, \
 				if k[0] == 'q':
 					ret = c;
 					break
-			d = time.time() - iter_t
 			print(line, "\t", last_l)
-			#d = time.time() - iter_t #this is duplicated on purpose
-			#time.sleep(T_step - d if d < T_step else 0.0) # delay at most T_step
+			sched.wait() # delay until the next period
 		ret = c
 
+	print('loop lateness [s]:', sched.lateness.summary())
+
 	if _end_sim:
 		stop_sim(client)
 	else:
@@ -0,0 +1,212 @@
+#!/bin/python
+"""
+PID tuning sweep: simulates the closed loop tank response for many
+(Kp, Ki, Kd) tunings at once, one NumPy array element per tuning, and ranks
+them by cost
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import sys
+import argparse as ap
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+							 '..', 'final'))
+from tank_sim import level_rate, outflow, SIM_DT
+
+#-------------------------------------------------------------------------------
+# Constants
+
+#plant loop period [s]
+T_STEP = 0.300
+
+#summary table columns
+METRICS = ('kp', 'ki', 'kd', 'cost', 'iae', 'overshoot', 'effort',
+		   'final_error')
+
+#-----------------------------------------------------------
+# Tunings
+
+def parse_range(arg):
+	"""
+	Parse lo:hi[:n] (n defaults to 10, 1 if lo == hi) or a single value
+	"""
+	parts = [float(v) for v in arg.split(':')]
+	if len(parts) == 1:
+		parts = parts*2
+	if len(parts) == 2:
+		parts.append(1 if parts[0] == parts[1] else 10)
+	return parts[0], parts[1], int(parts[2])
+
+def grid(kp, ki, kd):
+	"""
+	Every combination of the (lo, hi, n) ranges
+	:return (N, 3) array of tunings
+	"""
+	axes = [np.linspace(lo, hi, n) for lo, hi, n in (kp, ki, kd)]
+	return np.stack(np.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3)
+
+def random_tunings(kp, ki, kd, n, seed=None):
+	"""
+	n tunings drawn uniformly from the (lo, hi, _) ranges
+	:return (n, 3) array of tunings
+	"""
+	rng = np.random.default_rng(seed)
+	lo = np.array([kp[0], ki[0], kd[0]])
+	hi = np.array([kp[1], ki[1], kd[1]])
+	return lo + (hi - lo)*rng.random((n, 3))
+
+#-----------------------------------------------------------
+# Simulation
+
+def simulate(tunings, setpoint=0.5, level=0.0, in_valve=0.5, duration=300,
+			 T_step=T_STEP):
+	"""
+	Closed loop step response of every tuning, same controller as the plant
+	(simple_pid with error on the setpoint, derivative on the measurement and
+	the output and integral clamped to 0..1 driving the output valve)
+	:param tunings (N, 3) array of Kp, Ki, Kd
+	:return dict of metric name -> (N,) array
+	"""
+	kp, ki, kd = (np.asarray(tunings, dtype=float)[:, i] for i in range(3))
+	n = kp.size
+	h = np.full(n, float(level))
+	integral = np.zeros(n)
+	last_h = h.copy()
+	u = np.zeros(n)
+	iae = np.zeros(n)
+	effort = np.zeros(n)
+	peak = h.copy()
+	sub = max(1, int(np.ceil(T_step/SIM_DT)))
+	dt = T_step/sub
+
+	for _ in range(int(duration/T_step)):
+		#controller
+		e = setpoint - h
+		integral = np.clip(integral + ki*e*T_step, 0, 1)
+		u_new = np.clip(kp*e + integral - kd*(h - last_h)/T_step, 0, 1)
+		effort += np.abs(u_new - u)
+		u = u_new
+		last_h = h
+		#plant, held for one period
+		for _ in range(sub):
+			h = np.clip(h + dt*level_rate(h, in_valve, u), 0, 1)
+		iae += np.abs(setpoint - h)*T_step
+		peak = np.maximum(peak, h) if setpoint >= level \
+			else np.minimum(peak, h)
+
+	amp = setpoint - level
+	overshoot = np.maximum(0, (peak - setpoint)/amp)*100 if amp else \
+		np.zeros(n)
+	return {
+		'iae': iae,
+		'overshoot': overshoot,
+		'effort': effort,
+		'final_error': setpoint - h,
+		'outflow': outflow(h, u),
+	}
+
+def simulate_chunk(job):
+	"""
+	simulate() on one chunk of tunings, runs on a worker process
+	"""
+	tunings, kwargs = job
+	return simulate(tunings, **kwargs)
+
+def sweep(tunings, jobs=None, chunk=1024, w_overshoot=0.0, w_effort=0.0,
+		  **kwargs):
+	"""
+	Simulate the tunings split in chunks over a process pool and rank them
+	:param jobs worker processes, defaults to the CPU count
+	:param w_overshoot, w_effort cost weights, cost = iae +
+		w_overshoot*overshoot + w_effort*effort
+	:param kwargs simulate() arguments
+	:return dict of metric name -> (N,) array, sorted by increasing cost
+	"""
+	tunings = np.asarray(tunings, dtype=float)
+	chunks = [(tunings[i:i+chunk], kwargs)
+			  for i in range(0, len(tunings), chunk)]
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		parts = list(pool.map(simulate_chunk, chunks))
+	res = { k: np.concatenate([p[k] for p in parts]) for k in parts[0] }
+	res['kp'], res['ki'], res['kd'] = tunings.T
+	res['cost'] = res['iae'] + w_overshoot*res['overshoot'] + \
+		w_effort*res['effort']
+	order = np.argsort(res['cost'], kind='stable')
+	return { k: v[order] for k, v in res.items() }
+
+#-----------------------------------------------------------
+# Output
+
+def print_table(res, top, out=sys.stdout, sep=None):
+	"""
+	Print the best tunings, one row per tuning
+	:param sep column separator, aligned columns if None
+	"""
+	rows = [['{:.4g}'.format(res[k][i]) for k in METRICS]
+			for i in range(min(top, len(res['cost'])))]
+	if sep is not None:
+		for r in [METRICS] + rows:
+			out.write(sep.join(r) + '\n')
+		return
+	widths = [max(len(r[i]) for r in [METRICS] + rows)
+			  for i in range(len(METRICS))]
+	for r in [METRICS] + rows:
+		out.write('  '.join(v.rjust(w) for v, w in zip(r, widths)) + '\n')
+
+#------------------------------------------------------------------------------
+# Main
+
+if __name__ == '__main__':
+	parser = ap.ArgumentParser(description='Simulate the closed loop tank for '
+							   'a grid or random sample of PID tunings and '
+							   'rank them',
+							   epilog='give negative ranges with =, e.g. '
+							   '--kp=-50:0:25')
+	parser.add_argument('--kp', type=parse_range, default='-50:0:25',
+						metavar='lo:hi[:n]', help='defaults to -50:0:25')
+	parser.add_argument('--ki', type=parse_range, default='-5:0:20',
+						metavar='lo:hi[:n]', help='defaults to -5:0:20')
+	parser.add_argument('--kd', type=parse_range, default='-20:0:20',
+						metavar='lo:hi[:n]', help='defaults to -20:0:20')
+	parser.add_argument('--random', type=int, metavar='N',
+						help='draw N random tunings from the ranges instead '
+						'of the grid')
+	parser.add_argument('--seed', type=int)
+	parser.add_argument('--setpoint', type=float, default=0.5)
+	parser.add_argument('--level', type=float, default=0.0,
+						help='initial level')
+	parser.add_argument('--in_valve', type=float, default=0.5)
+	parser.add_argument('--duration', type=float, default=300,
+						help='simulated time [s], defaults to 300')
+	parser.add_argument('--w_overshoot', type=float, default=0.0,
+						help='cost weight of the overshoot [%%]')
+	parser.add_argument('--w_effort', type=float, default=0.0,
+						help='cost weight of the output valve travel')
+	parser.add_argument('-j', '--jobs', type=int, default=None,
+						help='worker processes, defaults to the CPU count')
+	parser.add_argument('-n', '--top', type=int, default=10,
+						help='rows to print, defaults to 10')
+	parser.add_argument('-o', '--out', help='write every tuning as CSV')
+	args = parser.parse_args()
+
+	if args.random:
+		tunings = random_tunings(args.kp, args.ki, args.kd, args.random,
+								 args.seed)
+	else:
+		tunings = grid(args.kp, args.ki, args.kd)
+
+	res = sweep(tunings, jobs=args.jobs, w_overshoot=args.w_overshoot,
+				w_effort=args.w_effort, setpoint=args.setpoint,
+				level=args.level, in_valve=args.in_valve,
+				duration=args.duration)
+	print_table(res, args.top)
+	print('best: --tunings={:.4f},{:.4f},{:.4f}'.format(
+		res['kp'][0], res['ki'][0], res['kd'][0]))
+	if args.out:
+		with open(args.out, 'w') as f:
+			print_table(res, len(res['cost']), f, sep=',')
@@ -0,0 +1,378 @@
+#!/bin/python
+"""
+Modbus load test of the SoftPLC: starts soft_plc.py against the simulated
+tank, polls it from several client connections with a read/write mix on the
+hr/co areas and reports throughput, request latency, dropped writes and the
+control loop period jitter while idle and under load. The results are saved
+as JSON to compare commits.
+@author: Henrique T. Moresco, Henrique Wolf, Lucas M. Mendes, Matheus R. Willemann
+"""
+
+#-------------------------------------------------------------------------------
+# Library Imports
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import random
+import socket
+import signal
+import tempfile
+import subprocess
+import argparse as ap
+from array import array
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+							 '..', 'final'))
+from pymodbus.client.sync import ModbusTcpClient
+from tags import TagDB, load_tags, TAGS_FILE
+from data_log import read_binary
+
+#-------------------------------------------------------------------------------
+# Constants
+
+SOFT_PLC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+						'..', 'final', 'soft_plc.py')
+#request types of the mix
+OPS = ('read_hr', 'read_co', 'write_hr', 'write_co')
+DEFAULT_MIX = 'read_hr=8,read_co=1,write_hr=1,write_co=0'
+#max wait for the server to listen [s]
+START_TIMEOUT = 20.0
+PERCENTILES = (50, 99, 99.9)
+
+#-----------------------------------------------------------
+# Utilities
+
+def parse_mix(arg):
+	"""
+	Parse op=weight,... into a dict of OPS weights
+	"""
+	mix = dict.fromkeys(OPS, 0.0)
+	for item in arg.split(','):
+		op, _, w = item.partition('=')
+		op = op.strip()
+		if op not in mix:
+			raise ap.ArgumentTypeError('unknown op {}'.format(op))
+		mix[op] = float(w)
+	if sum(mix.values()) <= 0:
+		raise ap.ArgumentTypeError('empty mix')
+	return mix
+
+def percentiles(values, ps=PERCENTILES):
+	"""
+	Nearest rank percentiles of a list of values
+	:return dict of 'p<p>' -> value, None for an empty list
+	"""
+	values = sorted(values)
+	res = {}
+	for p in ps:
+		key = 'p{:g}'.format(p).replace('.', '')
+		if not values:
+			res[key] = None
+			continue
+		i = min(len(values) - 1, max(0, int(round(p/100*len(values))) - 1))
+		res[key] = values[i]
+	return res
+
+def git_commit():
+	"""
+	Short hash of the checked out commit, None outside a git tree
+	"""
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def wait_listening(host, port, proc, timeout=START_TIMEOUT):
+	"""
+	Wait until the server accepts connections
+	"""
+	end = time.monotonic() + timeout
+	while time.monotonic() < end:
+		if proc.poll() is not None:
+			raise RuntimeError('soft_plc.py exited with {}'.format(
+				proc.returncode))
+		try:
+			socket.create_connection((host, port), timeout=0.5).close()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError('soft_plc.py is not listening on {}:{}'.format(
+		host, port))
+
+#------------------------------------------------------------------------------
+# Load generator
+
+def make_ops(tags):
+	"""
+	Request of each op as (client method name, address, value or count)
+	"""
+	setpoint = tags['SETPOINT']
+	return {
+		'read_hr': ('read_holding_registers', 0, tags.size['hr']),
+		'read_co': ('read_coils', 0, tags.size['co']),
+		#same values as the initial ones, the plant sees the command but
+		#keeps its operating point
+		'write_hr': ('write_register', setpoint.address, None),
+		'write_co': ('write_coil', tags['AUTO_MODE'].address, True),
+	}
+
+def client_worker(job):
+	"""
+	One client connection issuing requests until the end time
+	:param job dict with host, port, unit, ops, mix, rate, start, end, seed
+	:return dict of per op counts, errors and latencies [s] as array bytes
+	"""
+	rnd = random.Random(job['seed'])
+	names = [op for op in OPS if job['mix'][op] > 0]
+	weights = [job['mix'][op] for op in names]
+	client = ModbusTcpClient(job['host'], port=job['port'])
+	client.connect()
+	lat = array('d')
+	count = dict.fromkeys(OPS, 0)
+	errors = 0
+	period = 1/job['rate'] if job['rate'] else 0
+
+	time.sleep(max(0, job['start'] - time.time()))
+	t0 = time.perf_counter()
+	end = t0 + job['end'] - job['start']
+	n = 0
+	while True:
+		if period:
+			#latency from the scheduled send time, a slow server is not
+			#hidden by the client sending less
+			sent = t0 + n*period
+			time.sleep(max(0, sent - time.perf_counter()))
+		else:
+			sent = time.perf_counter()
+		if sent >= end:
+			break
+		op = rnd.choices(names, weights)[0]
+		method, address, arg = job['ops'][op]
+		if arg is None:
+			arg = job['setpoint']
+		try:
+			rr = getattr(client, method)(address, arg, unit=job['unit'])
+			if rr.isError():
+				errors += 1
+		except Exception:
+			errors += 1
+			client.close()
+			client.connect()
+		lat.append(time.perf_counter() - sent)
+		count[op] += 1
+		n += 1
+	client.close()
+	return {'count': count, 'errors': errors, 'latency': lat.tobytes()}
+
+def run_load(args, tags):
+	"""
+	Run the client connections in parallel processes
+	:return request counts, errors and latencies [s] of all connections
+	"""
+	start = time.time() + 1.0 #connect before the load starts
+	setpoint = tags['SETPOINT']
+	jobs = [{'host': args.host, 'port': args.port, 'unit': args.unit,
+			 'ops': make_ops(tags), 'mix': args.mix, 'rate': args.rate,
+			 'setpoint': int(setpoint.scale*args.setpoint),
+			 'start': start, 'end': start + args.duration, 'seed': i}
+			for i in range(args.connections)]
+	with Pool(args.connections) as pool:
+		results = pool.map(client_worker, jobs)
+	count = dict.fromkeys(OPS, 0)
+	lat = array('d')
+	errors = 0
+	for r in results:
+		for op, n in r['count'].items():
+			count[op] += n
+		errors += r['errors']
+		lat.frombytes(r['latency'])
+	return start, count, errors, lat
+
+#------------------------------------------------------------------------------
+# Control loop
+
+def loop_periods(logdir, t0, t1):
+	"""
+	Plant loop periods from the binary data log, split at the load window
+	:param t0, t1 load window in sample time (since the plant loop started)
+	:return (periods before t0, periods in [t0, t1]) [s]
+	"""
+	idle, load = [], []
+	for path in glob.glob(os.path.join(logdir, '*.bin')):
+		names, blocks = read_binary(path)
+		t_col, dt_col = names.index('time'), names.index('dt')
+		for cols in blocks:
+			for t, dt in zip(cols[t_col], cols[dt_col]):
+				if dt <= 0:
+					continue #first cycle
+				if t < t0:
+					idle.append(dt)
+				elif t <= t1:
+					load.append(dt)
+	return idle, load
+
+def period_stats(periods):
+	"""
+	Period mean and the jitter as deviation from the median period
+	"""
+	if not periods:
+		return {'n': 0}
+	median = sorted(periods)[len(periods)//2]
+	jitter = [abs(p - median) for p in periods]
+	res = {'n': len(periods), 'mean': sum(periods)/len(periods),
+		   'median': median, 'max': max(periods)}
+	res.update(('jitter_' + k, v) for k, v in percentiles(jitter).items())
+	return res
+
+#------------------------------------------------------------------------------
+# Report
+
+def report(res):
+	"""
+	Print the results
+	"""
+	l = res['latency']
+	print('{} connections, {:.1f} s, mix {}'.format(
+		res['args']['connections'], res['args']['duration'],
+		res['args']['mix']))
+	print('requests: {} errors: {} throughput: {:.1f} req/s'.format(
+		res['requests'], res['errors'], res['throughput']))
+	if l['p50'] is not None:
+		print('latency [ms] p50: {:.3f} p99: {:.3f} p999: {:.3f} max: {:.3f}'
+			  .format(1e3*l['p50'], 1e3*l['p99'], 1e3*l['p999'],
+					  1e3*l['max']))
+	for name in ('idle', 'load'):
+		p = res['loop'][name]
+		if p['n']:
+			print('loop period {} [ms] n: {} mean: {:.3f} jitter p50: {:.3f} '
+				  'p99: {:.3f} max period: {:.3f}'.format(
+					  name, p['n'], 1e3*p['mean'], 1e3*p['jitter_p50'],
+					  1e3*p['jitter_p99'], 1e3*p['max']))
+	for p in res['plants']:
+		print('plant {} dropped writes: {} discarded samples: {} soft plc: {}'
+			  .format(p['unit'], p['write_queue_dropped'],
+					  p.get('out_discarded'), p['soft_plc']['total']))
+
+def compare(res, path):
+	"""
+	Print the relative change of the main figures against older results
+	"""
+	with open(path) as f:
+		old = json.load(f)
+	figures = [('throughput', lambda r: r['throughput']),
+			   ('latency p50', lambda r: r['latency']['p50']),
+			   ('latency p99', lambda r: r['latency']['p99']),
+			   ('latency p999', lambda r: r['latency']['p999']),
+			   ('loop jitter p99', lambda r: r['loop']['load'].get(
+				   'jitter_p99'))]
+	print('compared to {} ({})'.format(path, old.get('commit')))
+	for name, get in figures:
+		a, b = get(old), get(res)
+		if a and b is not None:
+			print('  {}: {:.6g} -> {:.6g} ({:+.1f}%)'.format(
+				name, a, b, 100*(b - a)/a))
+
+#------------------------------------------------------------------------------
+# Main
+
+def main():
+	parser = ap.ArgumentParser(description=__doc__.split('@')[0],
+							   formatter_class=ap.RawTextHelpFormatter)
+	parser.add_argument('-c', '--connections', type=int, default=4,
+						help='client connections, defaults to 4')
+	parser.add_argument('-d', '--duration', type=float, default=10.0,
+						help='load duration [s], defaults to 10')
+	parser.add_argument('--idle', type=float, default=5.0,
+						help='loop period recorded without load before it '
+						'[s], defaults to 5')
+	parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+						help='request weights, defaults to ' + DEFAULT_MIX)
+	parser.add_argument('--rate', type=float, default=0,
+						help='requests/s of each connection, 0 (default) '
+						'sends the next request on the previous reply')
+	parser.add_argument('--setpoint', type=float, default=0,
+						help='value written to SETPOINT by write_hr')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('-p', '--port', type=int, default=5020)
+	parser.add_argument('--unit', type=int, default=0,
+						help='modbus unit id of the polled plant')
+	parser.add_argument('--tags', metavar='tags.csv', default=TAGS_FILE)
+	parser.add_argument('--plc_args', default='',
+						help='extra soft_plc.py arguments, e.g. '
+						'"--event_driven --register_image"')
+	parser.add_argument('-o', '--out', metavar='results.json',
+						help='save the results, defaults to '
+						'load_test_<commit>_<time>.json')
+	parser.add_argument('--compare', metavar='results.json',
+						help='print the change against older results')
+	args = parser.parse_args()
+	args.mix_arg = ','.join('{}={:g}'.format(k, v)
+							for k, v in args.mix.items())
+	tags = TagDB(load_tags(args.tags))
+
+	workdir = tempfile.mkdtemp(prefix='load_test_')
+	stats_path = os.path.join(workdir, 'stats.json')
+	cmd = [sys.executable, os.path.abspath(SOFT_PLC), args.host, args.host,
+		   '-p', str(args.port), '--sim', '--log_format', 'bin',
+		   '--tags', os.path.abspath(args.tags), '--stats_out', stats_path] \
+		+ shlex.split(args.plc_args)
+	with open(os.path.join(workdir, 'soft_plc.txt'), 'w') as out:
+		#the plant data log is written to the log/ folder of the workdir
+		proc = subprocess.Popen(cmd, cwd=workdir, stdout=out,
+								stderr=subprocess.STDOUT)
+	try:
+		wait_listening(args.host, args.port, proc)
+		client = ModbusTcpClient(args.host, port=args.port)
+		client.write_coil(tags['START_BTN'].address, True, unit=args.unit)
+		client.close()
+		time.sleep(args.idle)
+		start, count, errors, lat = run_load(args, tags)
+	finally:
+		proc.send_signal(signal.SIGINT) #writes the stats on shutdown
+		try:
+			proc.wait(timeout=START_TIMEOUT)
+		except subprocess.TimeoutExpired:
+			proc.kill()
+
+	with open(stats_path) as f:
+		plc_stats = json.load(f)
+	started = plc_stats['plants'][0]['started']
+	idle, load = loop_periods(os.path.join(workdir, 'log'), start - started,
+							  start - started + args.duration)
+	n = sum(count.values())
+	latency = percentiles(lat)
+	latency['max'] = max(lat) if lat else None
+	latency['mean'] = sum(lat)/n if n else None
+	res = {
+		'commit': git_commit(),
+		'time': time.time(),
+		'args': {'connections': args.connections,
+				 'duration': args.duration, 'mix': args.mix_arg,
+				 'rate': args.rate, 'plc_args': args.plc_args},
+		'requests': n,
+		'count': count,
+		'errors': errors,
+		'throughput': n/args.duration,
+		'latency': latency,
+		'loop': {'idle': period_stats(idle), 'load': period_stats(load)},
+		'plants': plc_stats['plants'],
+		'workdir': workdir,
+	}
+	report(res)
+	if args.compare:
+		compare(res, args.compare)
+	path = args.out or 'load_test_{}_{}.json'.format(res['commit'],
+													int(res['time']))
+	with open(path, 'w') as f:
+		json.dump(res, f, indent=1)
+	print('results: {}'.format(path))
+
+if __name__ == '__main__':
+	main()